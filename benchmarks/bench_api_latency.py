@@ -0,0 +1,79 @@
+"""
+列表接口压测: 并发请求 /assassin/tasks、/assassin/sub_tasks 统计延迟分位数
+
+先启动接口服务(python web.py)
+python benchmarks/bench_api_latency.py --url http://127.0.0.1:8888 --concurrency 200 --requests 2000
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from benchmarks.utils import summary
+
+
+async def worker(session, url, params, queue, latencies, errors):
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        begin = time.perf_counter()
+        try:
+            async with session.get(url, params=params) as rsp:
+                await rsp.read()
+                if rsp.status != 200:
+                    errors.append(rsp.status)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - begin)
+
+
+async def run(base_url, path, params, concurrency, total):
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+    latencies, errors = [], []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        begin = time.perf_counter()
+        await asyncio.gather(*[worker(session, base_url + path, params, queue, latencies, errors)
+                               for _ in range(concurrency)])
+        cost = time.perf_counter() - begin
+    return {
+        'path': path,
+        'params': params,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': len(errors),
+        'rps': round(total / cost, 1),
+        'latency_ms': summary(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8888')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--task-id', default='1')
+    opts = parser.parse_args()
+    cases = [
+        ('/assassin/tasks', {'page': '1', 'size': '20'}),
+        ('/assassin/sub_tasks', {'task_id': opts.task_id, 'page': '1', 'size': '20'}),
+    ]
+    loop = asyncio.get_event_loop()
+    for path, params in cases:
+        rst = loop.run_until_complete(run(opts.url, path, params, opts.concurrency, opts.requests))
+        print(json.dumps(rst, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+调度核心离线压测: MySQL/Redis/钉钉 使用本地替身(benchmarks/standins.py、配置见 conf/bench)、不依赖外部服务
+按任务规模依次测试:
+1、sync_schedule_task 全量(冷启动/已同步)及增量同步耗时、同步期间的事件循环延迟
+2、任务触发吞吐(抢锁 + 执行 + 状态回写)及调度延迟分位数
+3、monitor_tasks 耗时、报警写入本地队列及聚合发送耗时
+4、列表/统计接口延迟(进程内启动 web.py 的 Application)
+5、JSONFormatter 单条日志耗时、进程内存
+结果写入json文件(默认 benchmarks/results/)、便于不同版本之间对比
+
+python benchmarks/bench_core.py --rows 1000 10000 100000 --firings 2000
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+# 配置文件按相对路径读取、必须在导入项目模块之前设置
+os.chdir(project_path)
+os.environ.setdefault('APP_ENV', 'bench')
+BENCH_DIR = '/tmp/assassin-bench'
+os.makedirs(os.path.join(BENCH_DIR, 'logs'), exist_ok=True)
+# 清空上次运行遗留的报警队列(路径见 conf/bench/common.toml [alert].outbox)
+for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(os.path.join(BENCH_DIR, 'alert_outbox.db' + suffix)):
+        os.remove(os.path.join(BENCH_DIR, 'alert_outbox.db' + suffix))
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from tornado.httpserver import HTTPServer
+
+import main as app
+from libs.aps import monitor_tasks, lock_counter
+from libs.tomlread import ConfEntity
+from libs.utils.notice import alert_dispatcher
+from models.task import Task, TaskExecute
+from web.api import task as task_api
+from benchmarks import standins
+from benchmarks.utils import summary, loop_lag_ticker
+from benchmarks.bench_formatter import compare_formatters
+from benchmarks.bench_api_latency import run as api_run
+
+fired = {'count': 0}
+
+
+async def bench_noop(task_key, *args, **kwargs):
+    fired['count'] += 1
+
+
+async def measure(func, *args):
+    """
+    执行一次并纪录耗时及期间的事件循环延迟
+    SQLite 替身在事件循环线程中同步执行、同步任务时的阻塞时长会直接体现为 loop lag
+    """
+    samples, stop = [], asyncio.Event()
+    ticker = asyncio.ensure_future(loop_lag_ticker(samples, stop, interval=0.005))
+    await asyncio.sleep(0.02)
+    begin = time.perf_counter()
+    rst = await func(*args)
+    cost = time.perf_counter() - begin
+    await asyncio.sleep(0.02)
+    stop.set()
+    await ticker
+    return rst, {'ms': round(cost * 1000, 3), 'loop_lag_ms': summary(samples)}
+
+
+def memory():
+    """
+    ru_maxrss 在linux下单位为KB
+    """
+    rst = {'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        rst['rss_mb'] = round(rss_pages * resource.getpagesize() / 1024 / 1024, 1)
+    except (OSError, IndexError, ValueError):
+        pass
+    return rst
+
+
+def reset_scheduler():
+    app.scheduler.remove_all_jobs()
+    app.tasks_mapper.clear()
+    app.sync_state.update(watermark=None, cycles=0)
+
+
+async def bench_sync(rows, touched):
+    reset_scheduler()
+    _, cold = await measure(app.sync_schedule_task)
+    cold['jobs'] = len(app.scheduler.get_jobs())
+    # 已全部同步: 全表扫描但没有任务变化
+    app.sync_state['cycles'] = 0
+    _, steady = await measure(app.sync_schedule_task)
+    # 增量同步: 只拉取 update_at 超过水位的任务
+    touched = standins.touch_tasks(min(rows, touched))
+    _, incremental = await measure(app.sync_schedule_task)
+    incremental['touched'] = touched
+    return {'full_cold': cold, 'full_steady': steady, 'incremental': incremental}
+
+
+async def bench_firings(rows, firings, timeout):
+    """
+    同一时刻触发 firings 个date任务、统计从计划时间到最后一个任务执行完成的吞吐
+    计划时间预留出添加job的时间、调度延迟只包含调度及抢锁
+    """
+    count = min(rows, firings)
+    reset_scheduler()
+    fired['count'] = 0
+    no_lock = lock_counter.values.get(('get_no_lock', ), 0)
+    last = TaskExecute.select(TaskExecute.id).order_by(-TaskExecute.id).first()
+    run_at = datetime.now() + timedelta(seconds=1 + count * 0.0001)
+    begin = time.perf_counter()
+    tasks = list(Task.select(Task.id, Task.task_key).order_by(Task.id).limit(count))
+    for t in tasks:
+        app.trigger_operate.add_job('fire_{}'.format(t.id), 'date', run_at.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                    'bench_noop', t.task_key, '')
+    add_ms = round((time.perf_counter() - begin) * 1000, 3)
+    samples, stop = [], asyncio.Event()
+    ticker = asyncio.ensure_future(loop_lag_ticker(samples, stop))
+    app.scheduler.resume()
+    deadline = time.monotonic() + timeout
+    while fired['count'] + lock_counter.values.get(('get_no_lock', ), 0) - no_lock < count:
+        if time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.005)
+    finished_at = datetime.now()
+    app.scheduler.pause()
+    stop.set()
+    await ticker
+    elapsed = max((finished_at - run_at).total_seconds(), 1e-6)
+    lateness = [r.lateness_ms for r in TaskExecute.select(TaskExecute.lateness_ms).
+                where(TaskExecute.id > (last.id if last else 0), TaskExecute.lateness_ms.is_null(False))]
+    return {
+        'jobs': count,
+        'add_jobs_ms': add_ms,
+        'executed': fired['count'],
+        'get_no_lock': lock_counter.values.get(('get_no_lock', ), 0) - no_lock,
+        'timeout': fired['count'] < count,
+        'firings_per_sec': round(fired['count'] / elapsed, 1),
+        'lateness_ms': summary(lateness, scale=1),
+        'loop_lag_ms': summary(samples),
+    }
+
+
+async def bench_monitor(rows, sink, alarms):
+    standins.seed_executes([t.id for t in Task.select(Task.id)])
+    before = sink.requests
+    _, monitor = await measure(monitor_tasks)
+    # 报警写入本地队列(SQLite)的耗时、多个指纹聚合成一条消息
+    alert_dispatcher.sent_at.clear()
+    begin = time.perf_counter()
+    for i in range(alarms):
+        alert_dispatcher.notify('执行任务bench_{}异常: bench'.format(i % 100), task_key='bench_{}'.format(i % 100),
+                                err_type='bench')
+    notify_us = (time.perf_counter() - begin) / max(alarms, 1) * 1e6
+    _, flush = await measure(alert_dispatcher.flush, True)
+    return {
+        'monitor_tasks': monitor,
+        'alarm_notify_us': round(notify_us, 3),
+        'alarm_flush': flush,
+        'ding_requests': sink.requests - before,
+    }
+
+
+def load_web():
+    """
+    web.py 与 web 包同名、按文件路径加载
+    """
+    spec = importlib.util.spec_from_file_location('assassin_web', os.path.join(project_path, 'web.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def bench_api(rows, port, concurrency, requests):
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    first = Task.select(Task.id).order_by(Task.id).first()
+    cases = [
+        ('/assassin/tasks', {'page': '1', 'size': '20'}),
+        ('/assassin/tasks', {'page': str(max(1, rows // 40)), 'size': '20'}),
+        ('/assassin/tasks', {'after_id': str(max(1, rows // 2)), 'size': '20'}),
+        ('/assassin/sub_tasks', {'task_id': str(first.id if first else 1), 'page': '1', 'size': '20'}),
+        ('/assassin/task_stats', {'minutes': '60'}),
+    ]
+    return [await api_run(base_url, path, params, concurrency, requests) for path, params in cases]
+
+
+def run_scale(loop, rows, opts, sink):
+    # 接口模块导入时保存了 Manager 引用、每个规模重新绑定之后同步替换
+    task_api.objects = standins.bind_sqlite(os.path.join(BENCH_DIR, 'bench_{}.db'.format(rows)))
+    task_api.total_cache.clear()
+    begin = time.perf_counter()
+    standins.seed_tasks(rows)
+    rst = {'rows': rows, 'seed_ms': round((time.perf_counter() - begin) * 1000, 3)}
+    rst['sync'] = loop.run_until_complete(bench_sync(rows, opts.touched))
+    rst['memory_after_sync'] = memory()
+    rst['firings'] = loop.run_until_complete(bench_firings(rows, opts.firings, opts.timeout))
+    rst['monitor'] = loop.run_until_complete(bench_monitor(rows, sink, opts.alarms))
+    if opts.requests:
+        rst['api'] = loop.run_until_complete(bench_api(rows, opts.api_port, opts.concurrency, opts.requests))
+    reset_scheduler()
+    rst['memory'] = memory()
+    return rst
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--touched', type=int, default=100, help='增量同步时修改的任务数')
+    parser.add_argument('--firings', type=int, default=2000, help='同时触发的任务数上限')
+    parser.add_argument('--timeout', type=float, default=120, help='等待任务执行完成的最长时间(s)')
+    parser.add_argument('--alarms', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=500, help='每个接口的请求数、0表示跳过接口测试')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--api-port', type=int, default=18888)
+    parser.add_argument('--records', type=int, default=100000, help='JSONFormatter 测试日志条数')
+    parser.add_argument('--output', default='')
+    opts = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(standins.use_fakeredis())
+    ding = urlsplit(ConfEntity().common.get('ding', {}).get('ding', 'http://127.0.0.1:18765'))
+    sink = standins.DingSink(ding.hostname, ding.port)
+    loop.run_until_complete(sink.start())
+    app.trigger_operate.registry.register('bench_noop', bench_noop)
+    # 任务只在 bench_firings 中触发、其余时间暂停调度
+    app.scheduler.start(paused=True)
+    if opts.requests:
+        HTTPServer(load_web().Application()).listen(opts.api_port, '127.0.0.1')
+
+    scales = []
+    for rows in opts.rows:
+        scales.append(run_scale(loop, rows, opts, sink))
+        print(json.dumps(scales[-1], indent=2, ensure_ascii=False))
+
+    rst = {
+        'meta': {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'git_rev': git_rev(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(opts),
+        },
+        'scales': scales,
+        'formatter': compare_formatters(opts.records, 30),
+        'ding_sink': sink.stats(),
+        'memory': memory(),
+    }
+    loop.run_until_complete(sink.stop())
+    output = opts.output or os.path.join(project_path, 'benchmarks', 'results',
+                                         'bench_core_{}.json'.format(datetime.now().strftime('%Y%m%d%H%M%S')))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(rst, f, indent=2, ensure_ascii=False)
+    print('results: {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
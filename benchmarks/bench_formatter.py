@@ -0,0 +1,125 @@
+"""
+JSONFormatter 单条日志格式化耗时
+1、trace_id 从调用栈追溯 vs 从上下文(contextvars)读取
+2、JSONFormatter vs FastJSONFormatter(同一条日志输出一致)
+
+python benchmarks/bench_formatter.py --records 100000 --depth 30
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+import argparse
+import json
+import logging
+import time
+
+from libs.logger import JSONFormatter, FastJSONFormatter, orjson
+from libs.utils.other import trace_id_var, gen_uuid
+
+
+def make_record():
+    return logging.LogRecord('other', logging.INFO, __file__, 1, {'keyword': 'get_lock', 'ip': '127.0.0.1'},
+                             None, None)
+
+
+def at_depth(depth, func, *args):
+    """
+    模拟业务代码的调用深度(调用栈追溯需要逐层查找)
+    """
+    if depth <= 0:
+        return func(*args)
+    return at_depth(depth - 1, func, *args)
+
+
+def format_loop(formatter, record, records):
+    begin = time.perf_counter()
+    for _ in range(records):
+        formatter.format(record)
+    return time.perf_counter() - begin
+
+
+def stack_walk(formatter, records, depth):
+    __unique_trace_id__ = gen_uuid()
+    return at_depth(depth, format_loop, formatter, make_record(), records)
+
+
+def context_var(formatter, records, depth):
+    token = trace_id_var.set(gen_uuid())
+    try:
+        return at_depth(depth, format_loop, formatter, make_record(), records)
+    finally:
+        trace_id_var.reset(token)
+
+
+def make_records():
+    """
+    覆盖 dict/字符串/带参数/异常 几种日志
+    """
+    records = [
+        make_record(),
+        logging.LogRecord('other', logging.INFO, __file__, 1, {'keyword': 'get_lock', '__unique_trace_id__': 'x'},
+                          None, None),
+        logging.LogRecord('root', logging.WARNING, __file__, 1, '任务 %s 执行超时', ('test_cron', ), None),
+    ]
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        records.append(logging.LogRecord('root', logging.ERROR, __file__, 1, 'boom', None, sys.exc_info()))
+    return records
+
+
+def same_output(origin, fast, record, parsed):
+    """
+    对比输出是否一致(跨秒时时间字段不同、重试)
+    """
+    for _ in range(3):
+        a, b = origin.format(record), fast.format(record)
+        if (json.loads(a) == json.loads(b)) if parsed else (a == b):
+            return True
+    return False
+
+
+def compare_formatters(records, depth):
+    origin = JSONFormatter()
+    rst = {}
+    backends = ['json', 'orjson'] if orjson is not None else ['json']
+    token = trace_id_var.set(gen_uuid())
+    try:
+        for backend in backends:
+            fast = FastJSONFormatter(backend=backend)
+            identical = all(same_output(origin, fast, r, backend != 'json') for r in make_records())
+            cost = at_depth(depth, format_loop, fast, make_record(), records)
+            rst['fast_' + backend] = {'identical': identical, 'us_per_record': round(cost / records * 1e6, 3),
+                                      'records_per_sec': round(records / cost)}
+        cost = at_depth(depth, format_loop, origin, make_record(), records)
+        rst['origin'] = {'us_per_record': round(cost / records * 1e6, 3), 'records_per_sec': round(records / cost)}
+    finally:
+        trace_id_var.reset(token)
+    return rst
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=30)
+    opts = parser.parse_args()
+    formatter = JSONFormatter()
+    trace = {}
+    for name, case in (('stack_walk', stack_walk), ('context_var', context_var)):
+        cost = case(formatter, opts.records, opts.depth)
+        trace[name] = {'us_per_record': round(cost / opts.records * 1e6, 3),
+                       'records_per_sec': round(opts.records / cost)}
+    rst = {
+        'records': opts.records,
+        'depth': opts.depth,
+        'trace_id': trace,
+        'formatter': compare_formatters(opts.records, opts.depth),
+    }
+    print(json.dumps(rst, indent=2))
+
+
+if __name__ == '__main__':
+    main()
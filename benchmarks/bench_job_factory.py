@@ -0,0 +1,96 @@
+"""
+新增job耗时对比: TriggerOperate(job工厂) vs 旧版 eval 代码生成
+
+python benchmarks/bench_job_factory.py --jobs 10000
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+import argparse
+import asyncio
+import time
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+from libs.aps import lock, TriggerOperate, FuncRegistry
+
+SPECS = [
+    ('cron', '*/5 * * * *'),
+    ('cron', '0 3 * * *'),
+    ('cron', '15,45 * * * 1-5'),
+    ('interval', '30'),
+    ('date', '2099-01-01 00:00:00'),
+]
+
+
+async def bench_func(task_key, *args, **kwargs):
+    pass
+
+
+def legacy_add_trigger(trigger, spec, tid, execute_func, task_key, args):
+    """
+    旧版 TriggerOperate.add_trigger 代码生成
+    """
+    args = '"{}",'.format(task_key) + ','.join('"{}"'.format(arg) for arg in args.split(','))
+    if trigger == 'date':
+        return 'scheduler.add_job(lock({}), "date", run_date="{}", args=({},), id="{}")'.\
+            format(execute_func, spec, args, tid)
+    elif trigger == 'interval':
+        return 'scheduler.add_job(lock({}), "interval", seconds={}, args=({},), id="{}")'.\
+            format(execute_func, spec, args, tid)
+    return 'scheduler.add_job(lock({}), trigger=CronTrigger.from_crontab("{}"), args=({},), id="{}")'.\
+        format(execute_func, spec, args, tid)
+
+
+def make_scheduler():
+    scheduler = AsyncIOScheduler()
+    scheduler.start(paused=True)
+    return scheduler
+
+
+def run_legacy(jobs):
+    scheduler = make_scheduler()
+    namespace = {'scheduler': scheduler, 'lock': lock, 'CronTrigger': CronTrigger, 'bench_func': bench_func}
+    begin = time.perf_counter()
+    for i in range(jobs):
+        trigger, spec = SPECS[i % len(SPECS)]
+        eval(legacy_add_trigger(trigger, spec, 'legacy_{}'.format(i), 'bench_func', 'tk_{}'.format(i), '1,2,3'),
+             namespace)
+    cost = time.perf_counter() - begin
+    scheduler.shutdown(wait=False)
+    return cost
+
+
+def run_factory(jobs):
+    scheduler = make_scheduler()
+    registry = FuncRegistry()
+    registry.register('bench_func', bench_func)
+    operate = TriggerOperate(scheduler, registry)
+    begin = time.perf_counter()
+    for i in range(jobs):
+        trigger, spec = SPECS[i % len(SPECS)]
+        operate.add_job('factory_{}'.format(i), trigger, spec, 'bench_func', 'tk_{}'.format(i), '1,2,3')
+    cost = time.perf_counter() - begin
+    scheduler.shutdown(wait=False)
+    return cost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=10000)
+    opts = parser.parse_args()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    legacy = run_legacy(opts.jobs)
+    factory = run_factory(opts.jobs)
+    print('jobs: {}'.format(opts.jobs))
+    print('legacy eval: {:.3f}s  ({:.1f} us/job)'.format(legacy, legacy / opts.jobs * 1e6))
+    print('job factory: {:.3f}s  ({:.1f} us/job)'.format(factory, factory / opts.jobs * 1e6))
+    print('speedup: {:.2f}x'.format(legacy / factory if factory else 0))
+
+
+if __name__ == '__main__':
+    main()
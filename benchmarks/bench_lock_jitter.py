@@ -0,0 +1,101 @@
+"""
+lock 装饰器对事件循环的阻塞情况: 500个任务同时到期、对比同步/异步加锁时调度循环的抖动
+
+需要可用的 MySQL(mysql.toml default)、脚本会创建 bench_lock_* 任务并在结束后删除
+python benchmarks/bench_lock_jitter.py --jobs 500 --mode sync
+python benchmarks/bench_lock_jitter.py --jobs 500 --mode async
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+import argparse
+import asyncio
+import json
+from datetime import datetime, timedelta
+from functools import wraps
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from libs.aps import lock
+from libs.utils.other import gen_uuid
+from models.task import Task, TaskExecute
+from benchmarks.utils import summary, loop_lag_ticker
+
+TASK_PREFIX = 'bench_lock_'
+
+
+def sync_lock(func):
+    """
+    旧版 lock: 同步事务直接在事件循环上执行
+    """
+    @wraps(func)
+    async def wrapper(task_key, *args, **kwargs):
+        execute_success, sub_task_id = Task.task_atomic_insert(task_key, gen_uuid())
+        if not execute_success:
+            return
+        await func(task_key, *args, **kwargs)
+        Task.task_atomic_update(task_key, sub_task_id, 'success', {})
+
+    return wrapper
+
+
+async def bench_func(task_key, *args, **kwargs):
+    done.add(task_key)
+
+
+done = set()
+
+
+def prepare_tasks(jobs):
+    cleanup_tasks()
+    rows = [dict(task_key='{}{}'.format(TASK_PREFIX, i), desc='bench', execute_func='bench_func',
+                 trigger='date', spec='now', args='', is_valid=1, status='ready', extra={}) for i in range(jobs)]
+    with Task._meta.database.atomic():
+        for idx in range(0, len(rows), 500):
+            Task.insert_many(rows[idx:idx + 500]).execute()
+    return [r['task_key'] for r in rows]
+
+
+def cleanup_tasks():
+    ids = [t.id for t in Task.select(Task.id).where(Task.task_key.startswith(TASK_PREFIX))]
+    if ids:
+        TaskExecute.delete().where(TaskExecute.task_id.in_(ids)).execute()
+        Task.delete().where(Task.id.in_(ids)).execute()
+
+
+async def run(jobs, mode, timeout):
+    task_keys = prepare_tasks(jobs)
+    wrap = sync_lock if mode == 'sync' else lock
+    scheduler = AsyncIOScheduler(job_defaults={'misfire_grace_time': 60})
+    fire_at = datetime.now() + timedelta(seconds=2)
+    for task_key in task_keys:
+        scheduler.add_job(wrap(bench_func), 'date', run_date=fire_at, args=(task_key, ), id=task_key)
+    samples, stop_event = [], asyncio.Event()
+    ticker = asyncio.ensure_future(loop_lag_ticker(samples, stop_event))
+    scheduler.start()
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while len(done) < jobs and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    stop_event.set()
+    await ticker
+    scheduler.shutdown(wait=False)
+    cleanup_tasks()
+    rst = {'mode': mode, 'jobs': jobs, 'finished': len(done), 'loop_lag_ms': summary(samples)}
+    print(json.dumps(rst, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--mode', choices=('sync', 'async'), default='async')
+    parser.add_argument('--timeout', type=int, default=60)
+    opts = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(opts.jobs, opts.mode, opts.timeout))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+指标打点耗时(Counter.inc / Histogram.observe)及 /metrics 渲染耗时
+
+python benchmarks/bench_metrics.py --events 1000000 --tasks 1000
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+import argparse
+import json
+import time
+
+from libs.metrics import Counter, Histogram, render
+
+
+def per_event(func, events):
+    begin = time.perf_counter()
+    for _ in range(events):
+        func()
+    return (time.perf_counter() - begin) / events * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--tasks', type=int, default=1000)
+    opts = parser.parse_args()
+    counter = Counter('bench_lock_total', 'bench', ['result'])
+    histogram = Histogram('bench_task_duration_seconds', 'bench', ['task_key'])
+    baseline = per_event(lambda: None, opts.events)
+    rst = {
+        'events': opts.events,
+        'counter_inc_us': round(per_event(lambda: counter.inc('get_lock'), opts.events) - baseline, 3),
+        'histogram_observe_us': round(per_event(lambda: histogram.observe(0.35, 'task_key'), opts.events) - baseline,
+                                      3),
+    }
+    for i in range(opts.tasks):
+        histogram.observe(0.35, 'task_{}'.format(i))
+    begin = time.perf_counter()
+    body = render()
+    rst['render_ms'] = round((time.perf_counter() - begin) * 1000, 3)
+    rst['render_bytes'] = len(body)
+    print(json.dumps(rst, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+性能测试本地替身(APP_ENV=bench)
+MySQL -> SQLite: 模型重新绑定到SQLite、peewee_async.Manager 换成 SyncManager
+Redis -> fakeredis: 直接替换 Redis().redis_pools
+钉钉 -> 本地 aiohttp 接收服务(DingSink)、只计数不转发
+
+>>> manager = bind_sqlite('/tmp/assassin-bench/bench.db')
+>>> await use_fakeredis()
+>>> sink = DingSink('127.0.0.1', 18765)
+>>> await sink.start()
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+import peewee
+from aiohttp import web
+
+from libs.redis import Redis
+from libs.tomlread import ConfEntity
+from models.task import Task, TaskExecute
+
+__all__ = [
+    'SyncManager',
+    'DingSink',
+    'bind_sqlite',
+    'use_fakeredis',
+    'seed_tasks',
+    'seed_executes',
+    'touch_tasks',
+]
+
+# 与 README 中的表结构一致
+# create_at/update_at 默认取本地时间(同MySQL)、SQLite 没有 ON UPDATE、由 SyncManager.update 模拟
+SQLITE_DDL = (
+    'DROP TABLE IF EXISTS task',
+    'DROP TABLE IF EXISTS execute_task',
+    """CREATE TABLE task (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_key VARCHAR(255) NOT NULL,
+        "desc" VARCHAR(255) NOT NULL,
+        execute_func VARCHAR(255) NOT NULL,
+        "trigger" VARCHAR(255) NOT NULL,
+        spec VARCHAR(255) NOT NULL,
+        args VARCHAR(255) NOT NULL DEFAULT '',
+        is_valid INTEGER NOT NULL,
+        status VARCHAR(255) NOT NULL,
+        extra TEXT NOT NULL DEFAULT '{}',
+        create_at DATETIME NOT NULL DEFAULT (datetime('now', 'localtime')),
+        update_at DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+    )""",
+    'CREATE UNIQUE INDEX ux__task__task_key_status ON task (task_key, status)',
+    'CREATE INDEX ix__task__update_at ON task (update_at)',
+    """CREATE TABLE execute_task (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL,
+        status VARCHAR(255) NOT NULL,
+        extra TEXT NOT NULL DEFAULT '{}',
+        trace_id VARCHAR(255) NOT NULL,
+        fence_token BIGINT NOT NULL DEFAULT 0,
+        duration_ms INTEGER NULL,
+        scheduled_at DATETIME NULL,
+        lock_at DATETIME NULL,
+        start_at DATETIME NULL,
+        end_at DATETIME NULL,
+        lateness_ms INTEGER NULL,
+        create_at DATETIME NOT NULL DEFAULT (datetime('now', 'localtime')),
+        update_at DATETIME NOT NULL DEFAULT (datetime('now', 'localtime'))
+    )""",
+    'CREATE INDEX ix__execute_task__task_id_id ON execute_task (task_id, id)',
+    'CREATE INDEX ix__execute_task__start_at ON execute_task (start_at)',
+    'CREATE INDEX ix__execute_task__create_at ON execute_task (create_at)',
+)
+
+# 调度方式分布(cron 表达式共用 CronTrigger 缓存、interval 每个任务单独创建)
+SPECS = (
+    ('cron', '*/5 * * * *'),
+    ('cron', '0 * * * *'),
+    ('cron', '30 2 * * *'),
+    ('cron', '*/15 9-18 * * 1-5'),
+    ('interval', '3600'),
+    ('interval', '86400'),
+)
+
+# SQLite 单条语句最多999个变量、task 每行11个字段
+CHUNK_SIZE = 80
+
+
+class AsyncAtomic:
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    async def __aenter__(self):
+        return self.ctx.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.ctx.__exit__(*exc)
+
+
+class SyncManager:
+    """
+    peewee_async.Manager 接口的同步实现
+    SQLite 为本地文件、直接在事件循环线程中执行、耗时计入 loop lag
+    SELECT ... FOR UPDATE 去掉行锁(SQLite 写事务本身是串行的)
+    """
+    def __init__(self, database):
+        self.database = database
+
+    async def execute(self, query):
+        if getattr(query, '_for_update', None):
+            query = query.clone()
+            query._for_update = None
+        if isinstance(query, peewee.SelectBase):
+            return list(query)
+        return query.execute()
+
+    async def get(self, source, *args, **kwargs):
+        if isinstance(source, peewee.SelectBase):
+            rows = await self.execute(source.limit(1))
+            if not rows:
+                raise source.model.DoesNotExist
+            return rows[0]
+        return source.get(*args, **kwargs)
+
+    async def create(self, model, **data):
+        return model.create(**data)
+
+    async def count(self, query, clear_limit=False):
+        return query.count(clear_limit=clear_limit)
+
+    async def update(self, obj, only=None):
+        """
+        模拟 MySQL ON UPDATE CURRENT_TIMESTAMP: 没有显式写入 update_at 时取当前时间
+        整行保存(only=None)会写回读取到的 update_at、与MySQL一样不会更新
+        """
+        field = obj._meta.fields.get('update_at')
+        if field is not None and only is not None and field.name not in [getattr(f, 'name', f) for f in only]:
+            obj.update_at = datetime.now().replace(microsecond=0)
+            only = list(only) + [field]
+        return obj.save(only=only)
+
+    def atomic(self):
+        return AsyncAtomic(self.database.atomic())
+
+
+def bind_sqlite(path):
+    """
+    重建表结构并把 Task/TaskExecute 绑定到SQLite
+    web.api.task 导入时已经保存了 Manager 引用、导入之后需要另外替换 objects
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = peewee.SqliteDatabase(path, pragmas={'journal_mode': 'wal', 'synchronous': 'normal'})
+    db.bind([Task, TaskExecute])
+    for stmt in SQLITE_DDL:
+        db.execute_sql(stmt)
+    manager = SyncManager(db)
+    Task.async_objects = manager
+    TaskExecute.async_objects = manager
+    return manager
+
+
+async def use_fakeredis():
+    """
+    redis.toml 里的所有别名共用同一个 fakeredis 实例
+    fakeredis.aioredis 只在 fakeredis 1.x 中提供 aioredis 1.x 接口(版本见 benchmarks/requirements.txt)
+    """
+    import fakeredis.aioredis
+    pool = await fakeredis.aioredis.create_redis_pool()
+    Redis().redis_pools = {alias: pool for alias in ConfEntity().redis} or {'default': pool}
+    return pool
+
+
+def insert_chunks(model, rows):
+    db = model._meta.database
+    with db.atomic():
+        for i in range(0, len(rows), CHUNK_SIZE):
+            model.insert_many(rows[i:i + CHUNK_SIZE]).execute()
+
+
+def seed_tasks(count, execute_func='bench_noop', delay=60):
+    """
+    写入 count 个有效任务、update_at 设为1小时之前(低于增量同步水位的回看窗口)
+    """
+    at = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+    rows = []
+    for i in range(count):
+        trigger, spec = SPECS[i % len(SPECS)]
+        rows.append({
+            'task_key': 'bench_{}'.format(i), 'desc': 'bench', 'execute_func': execute_func, 'trigger': trigger,
+            'spec': spec, 'args': '"a","b"', 'is_valid': 1, 'status': 'ready', 'extra': {'delay': delay},
+            'create_at': at, 'update_at': at,
+        })
+    insert_chunks(Task, rows)
+
+
+def seed_executes(task_ids, age=timedelta(days=1)):
+    """
+    每个任务写入一条 age 之前的执行纪录(监控任务按最近一次执行时间判断是否报警)
+    """
+    at = datetime.now().replace(microsecond=0) - age
+    rows = [{'task_id': pk, 'status': 'success', 'extra': {}, 'trace_id': 'bench', 'create_at': at,
+             'update_at': at} for pk in task_ids]
+    insert_chunks(TaskExecute, rows)
+
+
+def touch_tasks(count, spec='*/10 * * * *'):
+    """
+    修改前 count 个任务的调度时间(模拟接口修改任务)、返回修改条数
+    """
+    ids = Task.select(Task.id).order_by(Task.id).limit(count)
+    return Task.update(spec=spec, update_at=datetime.now().replace(microsecond=0)).where(Task.id.in_(ids)).execute()
+
+
+class DingSink:
+    """
+    本地钉钉机器人接口: POST /robot/send 纪录请求数/消息长度、返回 errcode=0
+    """
+    def __init__(self, host='127.0.0.1', port=18765, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.requests = 0
+        self.bytes = 0
+        self.runner = None
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = await request.read()
+        self.requests += 1
+        self.bytes += len(body)
+        return web.json_response({'errcode': 0, 'errmsg': 'ok'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/robot/send', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def stats(self):
+        return {'requests': self.requests, 'bytes': self.bytes}
@@ -0,0 +1,42 @@
+"""
+性能测试公共方法
+"""
+import asyncio
+import math
+
+
+def percentile(samples, p):
+    """
+    计算分位数(最近秩法)
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    idx = max(0, min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+def summary(samples, scale=1000.0):
+    """
+    样本统计(默认秒转毫秒)
+    """
+    return {
+        'count': len(samples),
+        'p50': round(percentile(samples, 50) * scale, 3),
+        'p95': round(percentile(samples, 95) * scale, 3),
+        'p99': round(percentile(samples, 99) * scale, 3),
+        'max': round(max(samples) * scale, 3) if samples else 0,
+    }
+
+
+async def loop_lag_ticker(samples, stop_event, interval=0.01):
+    """
+    事件循环延迟探针: 每 interval 秒唤醒一次、纪录实际唤醒时间与预期的差值
+    """
+    loop = asyncio.get_event_loop()
+    while not stop_event.is_set():
+        begin = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - begin - interval))
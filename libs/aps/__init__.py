@@ -1,20 +1,50 @@
-from functools import wraps
+from functools import wraps, lru_cache
 import traceback
+import asyncio
+import importlib
+import time
+from copy import deepcopy
+from datetime import datetime
 
-from libs.utils.other import Environ, Host, gen_uuid
-from libs.utils.notice import ding_ding_notice
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from peewee import fn
+
+from libs.tomlread import ConfEntity
+from libs.utils.other import Environ, Host, gen_uuid, trace_id_var
+from libs.utils.notice import alert_dispatcher
 from libs.utils.datekit import datetime_fmt, datetime2timestamp, now_timestamp
 from libs.logger import LoggerPool
 from libs.redis import redis_pools
+from libs.redis.lease import RedisLease
 from models.task import Task, TaskExecute
+from libs.aps.lock_backends import get_lock_backend
+from libs.aps.execute_writer import execute_writer
+from libs.aps.retention import ExecuteArchiver
+from libs.aps.cluster import cluster
+from libs.aps.executors import EXECUTORS, resolve_executor, execute, scheduled_run_time_var
+from libs.metrics import Counter, Histogram
 
 ip = Host().host_ip()
 logger = LoggerPool.other
+sync_conf = ConfEntity().common.get('sync', {})
+retention_conf = ConfEntity().common.get('retention', {})
+# 任务变更推送频道
+TASK_CHANGED_CHANNEL = sync_conf.get('channel', 'assassin:task:changed')
+
+lock_counter = Counter('assassin_lock_total', '抢锁结果', ['result'])
+task_counter = Counter('assassin_task_runs_total', '任务执行次数', ['task_key', 'status'])
+task_lateness = Histogram('assassin_task_lateness_seconds', '任务实际开始时间与计划执行时间的差值(含抢锁耗时)', ['task_key'],
+                          buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+task_duration = Histogram('assassin_task_duration_seconds', '任务执行时长', ['task_key'])
+db_latency = Histogram('assassin_db_seconds', '任务锁数据库操作耗时', ['op'])
 
 
-def lock(func):
+def lock(func, executor='loop'):
     """
     to get lock in concurrent condition
+    :param executor: 任务方法执行方式 loop/thread/process、见 libs.aps.executors
     """
     @wraps(func)
     async def wrapper(*args, **kwargs):
@@ -25,127 +55,304 @@ def lock(func):
             logger.info({'keyword': 'receive_sigterm', 'ip': ip})
             return
 
-        # 生成trace_id
+        # 计划执行时间(apscheduler scheduled_run_time 转为本地时间、与 create_at 一致)
+        scheduled_run_time = scheduled_run_time_var.get()
+        scheduled_at = scheduled_run_time.astimezone().replace(tzinfo=None) if scheduled_run_time else None
+
+        # 生成trace_id、写入上下文供日志/请求/线程池读取
         __unique_trace_id__ = gen_uuid()
+        trace_id_var.set(__unique_trace_id__)
 
         # 执行原子操作
-        execute_success, sub_task_id = Task.task_atomic_insert(task_key, __unique_trace_id__)
+        begin = time.perf_counter()
+        grant = await get_lock_backend().acquire(task_key, __unique_trace_id__)
+        db_latency.observe(time.perf_counter() - begin, 'acquire')
 
         # 任务是否已被执行
-        if not execute_success:
+        if grant is None:
+            lock_counter.inc('get_no_lock')
             logger.info({'keyword': 'get_no_lock', 'ip': ip, 'task_key': task_key})
             return
+        lock_counter.inc('get_lock')
+        lock_at = datetime.now()
 
         # 将当前子任务ID及trace_id更新至kwargs参数
-        kwargs.update(sub_task_id=sub_task_id)
+        kwargs.update(sub_task_id=grant.sub_task_id)
         kwargs.update(__unique_trace_id__=__unique_trace_id__)
 
         # 开始执行任务
-        logger.info({'keyword': 'get_lock', 'ip': ip})
+        logger.info({'keyword': 'get_lock', 'ip': ip, 'fence_token': grant.fence_token, 'executor': executor})
         status, ext = 'success', {}
+        start_at = datetime.now()
+        # 调度延迟: 实际开始时间 - 计划执行时间
+        lateness_ms = None
+        if scheduled_at is not None:
+            lateness_ms = max(int((start_at - scheduled_at).total_seconds() * 1000), 0)
+            task_lateness.observe(lateness_ms / 1000, task_key)
+        begin = time.perf_counter()
         try:
-            await func(task_key, *args, **kwargs)
+            await execute(func, executor, task_key, *args, **kwargs)
         except Exception as e:
             logger.error({'panic_keyword': func.__name__, 'err': traceback.format_exc(),
                           'err_type': 'execute_task', 'ip': ip})
             status = 'fail'
             ext = {'err': traceback.format_exc()}
+        duration = time.perf_counter() - begin
+        end_at = datetime.now()
+        duration_ms = int(duration * 1000)
+        task_duration.observe(duration, task_key)
+        task_counter.inc(task_key, status)
 
         # 更新父任务和子任务状态
         try:
-            is_success, err = Task.task_atomic_update(task_key, sub_task_id, status, ext)
+            begin = time.perf_counter()
+            is_success, err = await get_lock_backend().release(grant, status, ext, duration_ms=duration_ms,
+                                                               scheduled_at=scheduled_at, lock_at=lock_at,
+                                                               start_at=start_at, end_at=end_at,
+                                                               lateness_ms=lateness_ms)
+            db_latency.observe(time.perf_counter() - begin, 'release')
             if not is_success:
-                await ding_ding_notice('执行任务{}, 更新任务状态失败: {}'.format(task_key, err))
+                alert_dispatcher.notify('执行任务{}, 更新任务状态失败: {}'.format(task_key, err),
+                                        task_key=task_key, err_type='update_status')
         except Exception as e:
             logger.error({'panic_keyword': func.__name__, 'err': traceback.format_exc(),
                           'err_type': 'execute_task', 'ip': ip})
-            await ding_ding_notice('执行任务{}异常：{}'.format(task_key, e))
+            alert_dispatcher.notify('执行任务{}异常：{}'.format(task_key, e), task_key=task_key,
+                                    err_type=type(e).__name__)
 
     return wrapper
 
 
-class TriggerOperate:
+@lru_cache(maxsize=1024)
+def cron_trigger(spec):
+    """
+    解析cron表达式
+    CronTrigger 只保存调度规则、不保存job状态、可以被多个job共用、按spec缓存
+    """
+    return CronTrigger.from_crontab(spec)
+
+
+class FuncRegistry:
+    """
+    任务方法注册表
+    execute_func 只在第一次使用时从 tasks 模块解析、按 方法名 + 执行方式 缓存 lock 包装之后的方法
+    同步方法(def)注册时自动改为线程池执行
+    """
+    def __init__(self, module='tasks'):
+        self.module = module
+        self.funcs = {}
+
+    def register(self, name, func, executor='loop'):
+        self.funcs[(name, executor)] = self.wrap(name, func, executor)
+
+    def get(self, name, executor='loop'):
+        if executor not in EXECUTORS:
+            raise ValueError('executor <{}> of execute_func <{}> should be one of {}'.format(executor, name, EXECUTORS))
+        func = self.funcs.get((name, executor))
+        if func is None:
+            origin = getattr(importlib.import_module(self.module), name, None)
+            if not callable(origin):
+                raise KeyError('execute_func <{}> is not defined in module <{}>'.format(name, self.module))
+            func = self.funcs[(name, executor)] = self.wrap(name, origin, executor)
+        return func
+
     @staticmethod
-    def modify_trigger(trigger, spec, tid):
+    def wrap(name, func, executor):
+        resolved = resolve_executor(func, executor)
+        if resolved != executor:
+            logger.info({'keyword': 'register_sync_func', 'execute_func': name, 'executor': resolved})
+        return lock(func, resolved)
+
+
+class TriggerOperate:
+    """
+    根据任务配置直接构建trigger对象及job参数
+    """
+    def __init__(self, scheduler, registry=None):
+        self.scheduler = scheduler
+        self.registry = registry or FuncRegistry()
+
+    def make_trigger(self, trigger, spec):
         """
-        根据trigger生成调度任务
+        根据trigger生成调度对象
         """
         if trigger == 'date':
             if spec == 'now':
-                _str = 'scheduler.reschedule_job("{}")'.format(tid)
-            else:
-                _str = 'scheduler.reschedule_job("{}", trigger="date", run_date="{}")'.format(tid, spec)
+                return DateTrigger(timezone=self.scheduler.timezone)
+            return DateTrigger(run_date=spec, timezone=self.scheduler.timezone)
         elif trigger == 'interval':
-            _str = 'scheduler.reschedule_job("{}", trigger="interval", seconds={})'.format(tid, spec)
-        else:
-            _str = 'scheduler.reschedule_job("{}", trigger=CronTrigger.from_crontab("{}"))'.format(tid, spec)
-        return _str
+            # IntervalTrigger 创建时即确定首次执行时间、不能缓存
+            return IntervalTrigger(seconds=float(spec), timezone=self.scheduler.timezone)
+        return cron_trigger(spec)
 
-    def add_trigger(self, trigger, spec, tid, execute_func, task_key, args):
-        args = self.make_args(task_key, args)
-        if trigger == 'date':
-            if spec == 'now':
-                _str = 'scheduler.add_job(lock({}), args=({},), id="{}")'.\
-                    format(execute_func, args, tid)
-            else:
-                _str = 'scheduler.add_job(lock({}), "date", run_date="{}", args=({},), id="{}")'.\
-                    format(execute_func, spec, args, tid)
-        elif trigger == 'interval':
-            _str = 'scheduler.add_job(lock({}), "interval", seconds={}, args=({},), id="{}")'.\
-                format(execute_func, spec, args, tid)
-        else:
-            _str = 'scheduler.add_job(lock({}), trigger=CronTrigger.from_crontab("{}"), args=({},), id="{}")'.\
-                format(execute_func, spec, args, tid)
-        return _str
+    def add_job(self, tid, trigger, spec, execute_func, task_key, args, executor='loop'):
+        func = self.registry.get(execute_func, executor)
+        return self.scheduler.add_job(func, trigger=self.make_trigger(trigger, spec),
+                                      args=self.make_args(task_key, args), id=tid)
+
+    def reschedule_job(self, tid, trigger, spec):
+        return self.scheduler.reschedule_job(tid, trigger=self.make_trigger(trigger, spec))
+
+    def modify_executor(self, tid, execute_func, executor='loop'):
+        return self.scheduler.modify_job(tid, func=self.registry.get(execute_func, executor))
+
+    @staticmethod
+    def get_executor(extra):
+        """
+        task.extra.executor: loop(默认)/thread/process
+        """
+        if not isinstance(extra, dict):
+            return 'loop'
+        return extra.get('executor') or 'loop'
 
     @staticmethod
     def make_args(task_key, args):
-        if type(args) is not str:
-            args = ''
-        if not args:
-            return '"{}"'.format(task_key)
-        args = args.replace('"', '').replace("'", '')
-        args_list = args.split(',')
-        args_with_double_quotes = ['"{}"'.format(arg) for arg in args_list]
-        return '"{}",'.format(task_key) + ','.join(args_with_double_quotes)
+        """
+        task.args 以逗号分隔、每个参数都是字符串(去掉两端的空白及引号)
+        >>> TriggerOperate.make_args('tk', '"guess", "hello"')
+        ('tk', 'guess', 'hello')
+        """
+        if type(args) is not str or not args:
+            return task_key,
+        return (task_key, ) + tuple(arg.strip().strip('"\'') for arg in args.split(','))
 
 
 async def monitor_tasks():
     """
     监控任务执行情况
+    只需要一个节点执行、注册时使用 libs.aps.leader.leader_only 包装
     """
-    rds = await redis_pools('default')
-    # 允许多实例间最大误差为60s
-    rst = await rds.set('assassin:unique:monitor_task', now_timestamp(), expire=60, exist='SET_IF_NOT_EXIST')
-    if not rst:
-        logger.info({'keyword': 'get_monitor_task_lock', 'ip': ip})
-        return
     alarms = ['assassin任务执行异常, 详情如下：\n任务key -- 默认延迟s -- 最近执行']
     tasks = await Task.async_objects.execute(Task.select().where(Task.is_valid == 1))
+    # 每个任务最近一次执行纪录: 按task_id取max(id)之后关联回execute_task(一次查询)
+    latest = TaskExecute.select(TaskExecute.task_id, fn.MAX(TaskExecute.id).alias('max_id')).\
+        group_by(TaskExecute.task_id).alias('latest')
+    subs = await TaskExecute.async_objects.execute(TaskExecute.select(TaskExecute.id, TaskExecute.task_id,
+                                                                      TaskExecute.create_at, TaskExecute.extra).
+                                                   join(latest, on=(TaskExecute.id == latest.c.max_id)))
+    latest_subs = {s.task_id: s for s in subs}
+    alarm_exts = {}
     for t in tasks:
-        sub = await TaskExecute.async_objects.execute(TaskExecute.select(TaskExecute.create_at,
-                                                                         TaskExecute.extra, TaskExecute.id).
-                                                      where(TaskExecute.task_id == t.id).
-                                                      order_by(-TaskExecute.id).limit(1))
-        for s in sub:
-            # 最近执行时间
-            bj = datetime_fmt(s.create_at)
-            last_stamp = datetime2timestamp(s.create_at) - 8 * 3600
-            delay = t.extra.get('delay', 3600)
-            if now_timestamp() - last_stamp > delay:
-                # 该报警是否已被处理
-                if not s.extra.get('deal_alarm'):
-                    alarms.append(f'{t.task_key} -- {delay} -- {bj}')
-                    t.update_ext(alarm_sub_task=s.id)
-            break
+        s = latest_subs.get(t.id)
+        if s is None:
+            continue
+        # 最近执行时间
+        bj = datetime_fmt(s.create_at)
+        last_stamp = datetime2timestamp(s.create_at) - 8 * 3600
+        delay = t.extra.get('delay', 3600)
+        if now_timestamp() - last_stamp > delay:
+            # 该报警是否已被处理
+            if not s.extra.get('deal_alarm'):
+                alarms.append(f'{t.task_key} -- {delay} -- {bj}')
+                ext = deepcopy(t.extra)
+                ext.update(alarm_sub_task=s.id)
+                alarm_exts[t.id] = ext
+    # 批量纪录报警的子任务
+    if alarm_exts:
+        await Task.async_bulk_update_extra(alarm_exts)
     if len(alarms) > 1:
-        await ding_ding_notice('\n'.join(alarms))
+        alert_dispatcher.notify('\n'.join(alarms), err_type='monitor_tasks')
+
+
+async def archive_execute_tasks():
+    """
+    归档过期的任务执行纪录
+    默认保留 [retention].days 天、单个任务可以通过 task.extra.retention_days 覆盖(<=0 表示永久保留)
+    注册时使用 leader_only 包装、归档耗时较长、另外加锁防止 leader 切换之后重复执行
+    """
+    if not retention_conf.get('enabled', False):
+        return
+    # 归档结束之后立即释放、只删除自己持有的锁
+    archive_lock = RedisLease('assassin:unique:archive_task', retention_conf.get('lock_ttl', 3600))
+    owner = '{}:{}'.format(ip, gen_uuid())
+    if not await archive_lock.acquire(owner):
+        logger.info({'keyword': 'get_archive_task_lock', 'ip': ip})
+        return
+    try:
+        await run_archive()
+    finally:
+        await archive_lock.release(owner)
+
+
+async def run_archive():
+    """
+    按任务的保留策略分组归档
+    """
+    tasks = await Task.async_objects.execute(Task.select(Task.id, Task.extra))
+    # 按保留天数对自定义策略的任务分组
+    policies = {}
+    for t in tasks:
+        days = t.extra.get('retention_days') if isinstance(t.extra, dict) else None
+        if days is None:
+            continue
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            # 配置错误的任务按默认保留天数归档、不影响其他任务
+            logger.error({'panic_keyword': 'retention_days_invalid', 'task_id': t.id, 'retention_days': days,
+                          'ip': ip})
+            continue
+        policies.setdefault(days, []).append(t.id)
+    archiver = ExecuteArchiver(retention_conf.get('archive_dir', '/data/logs/app/archive'),
+                               chunk_size=retention_conf.get('chunk_size', 1000),
+                               pause=retention_conf.get('pause', 0.1))
+    custom_ids = [pk for ids in policies.values() for pk in ids]
+    moved = await archiver.archive(retention_conf.get('days', 30), exclude_ids=custom_ids)
+    for days, ids in policies.items():
+        moved += await archiver.archive(days, task_ids=ids)
+    logger.info({'keyword': 'archive_execute_tasks_done', 'moved': moved, 'ip': ip})
 
 
 async def reset_tasks_status():
     """
-    程序退出之前更新所有doing状态任务为ready
+    程序退出之前更新doing状态任务为ready
     确保下次可以正常执行
+    集群模式下只重置属于当前节点的任务、其他节点正在执行的任务不受影响
     """
     logger.info('程序即将退出、重置任务状态')
-    await Task.async_objects.execute(Task.update(status='ready').where(Task.is_valid == 1, Task.status == 'doing'))
+    # 先把缓冲区的子任务状态写入数据库
+    await execute_writer.close()
+    query = Task.update(status='ready').where(Task.is_valid == 1, Task.status == 'doing')
+    if cluster.enabled:
+        doing = await Task.async_objects.execute(Task.select(Task.id, Task.task_key).
+                                                 where(Task.is_valid == 1, Task.status == 'doing'))
+        ids = [t.id for t in doing if cluster.owns(t.task_key)]
+        if not ids:
+            return
+        query = query.where(Task.id.in_(ids))
+    await Task.async_objects.execute(query)
+
+
+async def publish_task_changed(task_id):
+    """
+    推送任务变更消息(新增/修改任务之后调用)
+    推送失败不影响主流程、调度进程会在下个同步周期兜底
+    """
+    try:
+        rds = await redis_pools('default')
+        await rds.publish(TASK_CHANGED_CHANNEL, str(task_id))
+    except Exception:
+        logger.error({'panic_keyword': 'publish_task_changed_err', 'err': traceback.format_exc(),
+                      'task_id': task_id, 'ip': ip})
+
+
+async def subscribe_task_changed(callback, retry_interval=5):
+    """
+    订阅任务变更消息、收到消息后执行 callback(task_id)
+    连接断开之后自动重连
+    """
+    while True:
+        try:
+            rds = await redis_pools('default')
+            ch, = await rds.subscribe(TASK_CHANGED_CHANNEL)
+            logger.info({'keyword': 'subscribe_task_changed', 'channel': TASK_CHANGED_CHANNEL, 'ip': ip})
+            while await ch.wait_message():
+                task_id = await ch.get(encoding='utf-8')
+                if not task_id or not task_id.isdigit():
+                    continue
+                await callback(int(task_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error({'panic_keyword': 'subscribe_task_changed_err', 'err': traceback.format_exc(), 'ip': ip})
+        await asyncio.sleep(retry_interval)
@@ -0,0 +1,115 @@
+"""
+调度集群
+每个节点定时把心跳写入 redis ZSET(score为心跳时间)、超过ttl没有心跳的节点视为下线
+存活节点构成一致性hash环、每个节点只调度 task_key 落在自己身上的任务
+节点加入/退出时只有相邻区间的任务会迁移
+"""
+import os
+import time
+import bisect
+import hashlib
+import traceback
+
+from libs.tomlread import ConfEntity
+from libs.logger import LoggerPool
+from libs.redis import redis_pools
+from libs.utils.other import Host
+
+logger = LoggerPool.other
+cluster_conf = ConfEntity().common.get('cluster', {})
+
+__all__ = [
+    'HashRing',
+    'ClusterMembership',
+    'cluster',
+]
+
+
+def hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    一致性hash环、每个节点映射 vnodes 个虚拟节点使任务分布均匀
+    >>> ring = HashRing(['10.0.0.1:100', '10.0.0.2:200'])
+    >>> ring.owner('task_key')
+    '10.0.0.2:200'
+    """
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.nodes = tuple(sorted(set(nodes)))
+        points = sorted((hash_key('{}#{}'.format(node, i)), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        idx = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[idx]
+
+
+class ClusterMembership:
+    """
+    >>> await cluster.heartbeat()           # 定时执行、节点变化时返回True
+    >>> cluster.owns('task_key')            # 未开启集群模式时总是返回True
+    >>> await cluster.leave()               # 程序退出前主动下线
+    """
+    def __init__(self, enabled=False, key='assassin:cluster:nodes', ttl=30, vnodes=160, alias='default',
+                 node_id=None):
+        self.enabled = enabled
+        self.key = key
+        self.ttl = ttl
+        self.alias = alias
+        self.node_id = node_id or '{}:{}'.format(Host().host_ip(), os.getpid())
+        # 第一次心跳之前只有自己
+        self.ring = HashRing([self.node_id], vnodes)
+        self.vnodes = vnodes
+        # 节点变化次数、同步任务时据此判断是否需要全量重新分配
+        self.version = 0
+
+    def owns(self, task_key):
+        if not self.enabled:
+            return True
+        return self.ring.owner(task_key) == self.node_id
+
+    async def heartbeat(self):
+        if not self.enabled:
+            return False
+        now = time.time()
+        try:
+            rds = await redis_pools(self.alias)
+            tr = rds.multi_exec()
+            tr.zadd(self.key, now, self.node_id)
+            tr.zremrangebyscore(self.key, max=now - self.ttl)
+            tr.zrangebyscore(self.key, min=now - self.ttl, encoding='utf-8')
+            _, _, nodes = await tr.execute()
+        except Exception:
+            # redis不可用时保持当前的节点列表
+            logger.error({'panic_keyword': 'cluster_heartbeat_err', 'err': traceback.format_exc(),
+                          'node': self.node_id})
+            return False
+        nodes = tuple(sorted(set(nodes) | {self.node_id}))
+        if nodes == self.ring.nodes:
+            return False
+        logger.info({'keyword': 'cluster_nodes_changed', 'node': self.node_id, 'from': self.ring.nodes, 'to': nodes})
+        self.ring = HashRing(nodes, self.vnodes)
+        self.version += 1
+        return True
+
+    async def leave(self):
+        if not self.enabled:
+            return
+        try:
+            rds = await redis_pools(self.alias)
+            await rds.zrem(self.key, self.node_id)
+        except Exception:
+            logger.error({'panic_keyword': 'cluster_leave_err', 'err': traceback.format_exc(), 'node': self.node_id})
+
+
+cluster = ClusterMembership(enabled=cluster_conf.get('enabled', False),
+                            key=cluster_conf.get('key', 'assassin:cluster:nodes'),
+                            ttl=cluster_conf.get('ttl', 30),
+                            vnodes=cluster_conf.get('vnodes', 160),
+                            alias=cluster_conf.get('redis', 'default'))
@@ -0,0 +1,155 @@
+"""
+execute_task 写缓冲(write-behind)
+子任务的 status/duration/extra 先写入内存、按条数或时间阈值批量刷新到MySQL
+父任务的状态(task.status 执行锁)不经过缓冲、仍然实时更新
+通过 common.toml [execute_writer] 开启、默认关闭
+"""
+import asyncio
+import time
+import traceback
+
+from libs.tomlread import ConfEntity
+from libs.utils.other import Host
+from libs.logger import LoggerPool
+from libs.metrics import Gauge
+from models.task import TaskExecute
+
+
+__all__ = [
+    'ExecuteWriter',
+    'execute_writer',
+]
+
+ip = Host().host_ip()
+logger = LoggerPool.other
+
+
+class ExecuteWriter:
+    """
+    >>> execute_writer.put(sub_task_id, extra={'err': '...'}, status='fail', duration_ms=12)
+    >>> await execute_writer.close()    # 程序退出前刷新剩余数据
+    """
+    def __init__(self, enabled=False, max_size=200, flush_interval=1.0, max_retries=30, max_pending=10000):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        # 单条数据最多写入次数、超过之后丢弃(避免一条写不进去的数据拖住整个缓冲区)
+        self.max_retries = max_retries
+        # 缓冲区最大条数、数据库长时间不可用时丢弃新数据
+        self.max_pending = max_pending
+        self.pending = {}
+        self.flusher = None
+        # 同一时刻只有一个刷新在执行
+        self.flushing = False
+        # 上次刷新失败之后只由后台周期重试、不再按条数触发
+        self.failing = False
+        self.counters = {
+            'flushes': 0,
+            'flushed_rows': 0,
+            'flush_errors': 0,
+            'dropped_rows': 0,
+            'last_flush_ms': 0,
+            'max_flush_ms': 0,
+            'total_flush_ms': 0,
+        }
+
+    def put(self, sub_task_id, extra=None, **fields):
+        """
+        同一个子任务的多次更新在缓冲区内合并
+        """
+        if sub_task_id not in self.pending and len(self.pending) >= self.max_pending:
+            self.counters['dropped_rows'] += 1
+            return
+        entry = self.pending.setdefault(sub_task_id, {'fields': {}, 'extra': {}, 'attempts': 0})
+        entry['fields'].update(fields)
+        entry['extra'].update(extra or {})
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.run())
+        if len(self.pending) >= self.max_size and not self.flushing and not self.failing:
+            asyncio.ensure_future(self.flush())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if self.flushing or not self.pending:
+            return
+        self.flushing = True
+        batch, self.pending = self.pending, {}
+        try:
+            # 重试的数据单独写一批、写不进去的数据不影响新数据
+            fresh = {pk: entry for pk, entry in batch.items() if not entry['attempts']}
+            retry = {pk: entry for pk, entry in batch.items() if entry['attempts']}
+            for rows in (fresh, retry):
+                if rows:
+                    await self.write(rows)
+        finally:
+            self.flushing = False
+
+    async def write(self, batch):
+        begin = time.perf_counter()
+        try:
+            await TaskExecute.async_bulk_update(batch)
+        except Exception:
+            self.failing = True
+            self.counters['flush_errors'] += 1
+            dropped = self.restore(batch)
+            logger.error({'panic_keyword': 'execute_writer_flush_err', 'err': traceback.format_exc(),
+                          'rows': len(batch), 'dropped': dropped, 'ip': ip})
+            return
+        self.failing = False
+        cost = (time.perf_counter() - begin) * 1000
+        self.counters['flushes'] += 1
+        self.counters['flushed_rows'] += len(batch)
+        self.counters['last_flush_ms'] = cost
+        self.counters['total_flush_ms'] += cost
+        self.counters['max_flush_ms'] = max(self.counters['max_flush_ms'], cost)
+
+    def restore(self, batch):
+        """
+        写失败的数据放回缓冲区、期间产生的新数据优先
+        超过重试次数或缓冲区已满的数据丢弃、返回丢弃条数
+        """
+        dropped = 0
+        for pk, entry in batch.items():
+            entry['attempts'] += 1
+            newer = self.pending.get(pk)
+            if entry['attempts'] >= self.max_retries or (newer is None and len(self.pending) >= self.max_pending):
+                dropped += 1
+                continue
+            if newer:
+                entry['fields'].update(newer['fields'])
+                entry['extra'].update(newer['extra'])
+            self.pending[pk] = entry
+        self.counters['dropped_rows'] += dropped
+        return dropped
+
+    async def close(self):
+        # 等待进行中的刷新完成、避免取消后台协程时中断写入
+        while self.flushing:
+            await asyncio.sleep(0.01)
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        logger.info({'keyword': 'execute_writer_closed', 'stats': self.stats(), 'ip': ip})
+
+    def stats(self):
+        rst = dict(self.counters)
+        rst['queue_depth'] = len(self.pending)
+        rst['avg_flush_ms'] = rst['total_flush_ms'] / rst['flushes'] if rst['flushes'] else 0
+        return rst
+
+
+writer_conf = ConfEntity().common.get('execute_writer', {})
+execute_writer = ExecuteWriter(enabled=writer_conf.get('enabled', False),
+                               max_size=writer_conf.get('max_size', 200),
+                               flush_interval=writer_conf.get('flush_interval', 1.0),
+                               max_retries=writer_conf.get('max_retries', 30),
+                               max_pending=writer_conf.get('max_pending', 10000))
+
+Gauge('assassin_execute_writer_queue', '子任务状态写缓冲中待写入的条数', fn=lambda: len(execute_writer.pending))
+Gauge('assassin_execute_writer_dropped', '子任务状态写缓冲丢弃的条数(超过重试次数或缓冲区已满)',
+      fn=lambda: execute_writer.counters['dropped_rows'])
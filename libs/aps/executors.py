@@ -0,0 +1,148 @@
+"""
+任务执行方式
+loop: 直接在调度进程的事件循环中执行(默认)
+thread: 在共享线程池中执行、适合有阻塞调用的任务(同步方法自动使用该方式)
+process: 在共享进程池中执行、适合CPU密集型任务
+thread/process 只支持同步方法(def): redis/MySQL/http 连接池都绑定在调度进程的事件循环上、不能在其他事件循环中使用
+进程池中按 模块名 + 方法名 重新导入任务方法执行、任务方法需要能够独立运行(自行初始化连接等资源)
+"""
+import asyncio
+import importlib
+import multiprocessing
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from apscheduler.executors.asyncio import AsyncIOExecutor
+
+from libs.tomlread import ConfEntity
+from libs.logger import LoggerPool
+from libs.utils.other import context_wrapper, trace_id_var
+from libs.utils.pool import shared_thread_pool, shared_pool_stats, shutdown_shared_pool
+from libs.metrics import Gauge
+
+logger = LoggerPool.other
+executor_conf = ConfEntity().common.get('executor', {})
+
+__all__ = [
+    'ScheduledTimeAsyncIOExecutor',
+    'scheduled_run_time_var',
+    'EXECUTORS',
+    'resolve_executor',
+    'execute',
+    'report_pool_stats',
+    'shutdown_executors',
+]
+
+EXECUTORS = ('loop', 'thread', 'process')
+
+# 当前job本次应该执行的时间(apscheduler scheduled_run_time)、用于统计调度延迟
+scheduled_run_time_var = ContextVar('scheduled_run_time', default=None)
+
+_pools = {}
+
+
+def pool_stat(name):
+    """
+    采集指标时不创建线程池、还没有创建时为0
+    """
+    stats = shared_pool_stats()
+    return stats[name] if stats is not None else 0
+
+
+Gauge('assassin_thread_pool_active', '共享线程池执行中的任务数', fn=lambda: pool_stat('active'))
+Gauge('assassin_thread_pool_queued', '共享线程池排队中的任务数', fn=lambda: pool_stat('queued'))
+
+
+class ScheduledTimeAsyncIOExecutor(AsyncIOExecutor):
+    """
+    提交job之前把本次计划执行时间写入上下文
+    create_task 会复制当前上下文、job协程中可以通过 scheduled_run_time_var 读取
+    """
+    def _do_submit_job(self, job, run_times):
+        token = scheduled_run_time_var.set(run_times[-1])
+        try:
+            return super(ScheduledTimeAsyncIOExecutor, self)._do_submit_job(job, run_times)
+        finally:
+            scheduled_run_time_var.reset(token)
+
+
+def get_pool(executor):
+    """
+    同一进程内共享、第一次使用时创建
+    """
+    if executor == 'thread':
+        return shared_thread_pool()
+    pool = _pools.get(executor)
+    if pool is None:
+        # 默认spawn: 调度进程中有日志线程/连接池等状态、fork之后不可用
+        ctx = multiprocessing.get_context(executor_conf.get('process_start_method', 'spawn'))
+        pool = _pools[executor] = ProcessPoolExecutor(max_workers=executor_conf.get('process_workers', 2),
+                                                      mp_context=ctx)
+    return pool
+
+
+def resolve_executor(func, executor='loop'):
+    """
+    同步方法不能在事件循环中 await、默认放到线程池执行
+    协程方法只能在调度进程的事件循环中执行
+    """
+    is_coroutine = asyncio.iscoroutinefunction(func)
+    if executor == 'loop' and not is_coroutine:
+        return 'thread'
+    if executor in ('thread', 'process') and is_coroutine:
+        raise ValueError('executor <{}> only supports sync functions, <{}> is a coroutine function'.format(
+            executor, func.__name__))
+    return executor
+
+
+def process_entry(module, name, trace_id, args, kwargs):
+    """
+    子进程入口
+    """
+    trace_id_var.set(trace_id)
+    func = getattr(importlib.import_module(module), name)
+    return func(*args, **kwargs)
+
+
+async def execute(func, executor, *args, **kwargs):
+    """
+    按执行方式执行任务方法
+    >>> await execute(test_cron, 'process', 'tk', sub_task_id=1, __unique_trace_id__='xxx')
+    """
+    if executor not in ('thread', 'process'):
+        return await func(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    if executor == 'thread':
+        return await loop.run_in_executor(get_pool('thread'), context_wrapper(func, *args, **kwargs))
+    pool = get_pool('process')
+    try:
+        return await loop.run_in_executor(pool, process_entry, func.__module__, func.__name__,
+                                          trace_id_var.get(), args, kwargs)
+    except BrokenProcessPool:
+        # 子进程异常退出之后进程池不可用、丢弃之后下次执行重新创建
+        if _pools.get('process') is pool:
+            _pools.pop('process')
+            pool.shutdown(wait=False)
+        logger.error({'panic_keyword': 'process_pool_broken', 'func': func.__name__})
+        raise
+
+
+async def report_pool_stats():
+    """
+    定时纪录共享线程池使用情况、有排队时说明线程池已饱和
+    """
+    stats = shared_pool_stats()
+    if stats is None:
+        return
+    if stats['queued'] > 0:
+        logger.error({'panic_keyword': 'thread_pool_saturated', 'stats': stats})
+    else:
+        logger.info({'keyword': 'thread_pool_stats', 'stats': stats})
+
+
+def shutdown_executors(wait=False):
+    for pool in _pools.values():
+        pool.shutdown(wait=wait)
+    _pools.clear()
+    shutdown_shared_pool(wait=wait)
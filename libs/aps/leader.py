@@ -0,0 +1,118 @@
+"""
+基于 Redis 租约的 leader 选举
+所有节点定时竞选: leader 续约、其他节点尝试抢占租约
+leader 异常退出之后最多 ttl + interval 秒内由其他节点接管
+只需要一个节点执行的任务(监控/归档等)使用 leader_only 包装
+"""
+import os
+import time
+import traceback
+from functools import wraps
+
+from libs.tomlread import ConfEntity
+from libs.logger import LoggerPool
+from libs.redis.lease import RedisLease
+from libs.metrics import Gauge
+from libs.utils.other import Host
+
+logger = LoggerPool.other
+leader_conf = ConfEntity().common.get('leader', {})
+
+__all__ = [
+    'LeaderElector',
+    'leader_only',
+    'elector',
+]
+
+
+class LeaderElector:
+    """
+    >>> await elector.campaign()       # 定时执行、间隔需小于ttl
+    >>> elector.is_leader
+    >>> await elector.resign()         # 程序退出前主动让出
+    """
+    def __init__(self, enabled=True, key='assassin:leader', ttl=15, alias='default', node_id=None):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.node_id = node_id or '{}:{}'.format(Host().host_ip(), os.getpid())
+        # fencing token 作为任期(term)、每次选出新的 leader 递增
+        self.lease = RedisLease(key, ttl, fence_key='{}:term'.format(key), alias=alias)
+        self.leading = False
+        self.term = 0
+        # 最近一次续约成功之后租约的到期时间、redis不可用时到期即认为已失去leader身份
+        self.expire_at = 0
+        self.changes = 0
+
+    @property
+    def is_leader(self):
+        if not self.enabled:
+            return True
+        return self.leading and time.monotonic() < self.expire_at
+
+    async def campaign(self):
+        if not self.enabled:
+            return
+        begin = time.monotonic()
+        try:
+            if self.leading:
+                ok = await self.lease.renew(self.node_id)
+                term = self.term if ok else 0
+            else:
+                term = await self.lease.acquire(self.node_id)
+                ok = term > 0
+        except Exception:
+            logger.error({'panic_keyword': 'leader_campaign_err', 'err': traceback.format_exc(), 'node': self.node_id})
+            ok, term = False, self.term
+            # 续约失败但租约未到期、保持当前身份等待下次续约
+            if self.is_leader:
+                return
+        if ok:
+            self.expire_at = begin + self.ttl
+        self.set_leading(ok, term)
+
+    def set_leading(self, leading, term):
+        if leading == self.leading:
+            return
+        self.leading = leading
+        self.changes += 1
+        if leading:
+            self.term = term
+        logger.info({'keyword': 'leader_changed', 'node': self.node_id, 'is_leader': leading, 'term': self.term,
+                     'changes': self.changes})
+
+    async def resign(self):
+        if not self.enabled or not self.leading:
+            return
+        try:
+            await self.lease.release(self.node_id)
+        except Exception:
+            logger.error({'panic_keyword': 'leader_resign_err', 'err': traceback.format_exc(), 'node': self.node_id})
+        self.set_leading(False, self.term)
+
+    def stats(self):
+        return {'is_leader': int(self.is_leader), 'term': self.term, 'changes': self.changes, 'node': self.node_id}
+
+
+elector = LeaderElector(enabled=leader_conf.get('enabled', True),
+                        key=leader_conf.get('key', 'assassin:leader'),
+                        ttl=leader_conf.get('ttl', 15),
+                        alias=leader_conf.get('redis', 'default'))
+
+Gauge('assassin_leader', '当前节点是否为leader', fn=lambda: elector.is_leader)
+Gauge('assassin_leader_term', '当前节点最近一次成为leader时的任期', fn=lambda: elector.term)
+Gauge('assassin_leader_changes', '当前节点leader身份变化次数', fn=lambda: elector.changes)
+
+
+def leader_only(func):
+    """
+    只在 leader 节点执行
+    >>> scheduler.add_job(leader_only(monitor_tasks), trigger=...)
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not elector.is_leader:
+            logger.info({'keyword': 'skip_not_leader', 'func': func.__name__, 'node': elector.node_id})
+            return
+        return await func(*args, **kwargs)
+
+    return wrapper
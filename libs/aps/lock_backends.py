@@ -0,0 +1,132 @@
+"""
+任务执行锁
+mysql: task表行锁(SELECT ... FOR UPDATE) + status字段(ready/doing)
+redis: redis租约(SET NX PX) + fencing token、只有抢占成功的节点才会写MySQL
+通过 common.toml [lock].backend 配置、默认mysql
+"""
+import asyncio
+import traceback
+from functools import lru_cache
+
+from libs.tomlread import ConfEntity
+from libs.utils.other import Host
+from libs.logger import LoggerPool
+from libs.redis.lease import RedisLease
+from models.task import Task
+from libs.aps.execute_writer import execute_writer
+
+
+__all__ = [
+    'LockGrant',
+    'MysqlLockBackend',
+    'RedisLockBackend',
+    'get_lock_backend',
+]
+
+ip = Host().host_ip()
+logger = LoggerPool.other
+
+
+class LockGrant:
+    """
+    抢占成功之后的凭证
+    """
+    def __init__(self, task_key, trace_id, sub_task_id, task_id=None, fence_token=None):
+        self.task_key = task_key
+        self.trace_id = trace_id
+        self.sub_task_id = sub_task_id
+        self.task_id = task_id
+        self.fence_token = fence_token
+        self.lease = None
+        self.keeper = None
+
+
+class MysqlLockBackend:
+    async def acquire(self, task_key, trace_id):
+        execute_success, sub_task_id = await Task.async_task_atomic_insert(task_key, trace_id)
+        if not execute_success:
+            return None
+        return LockGrant(task_key, trace_id, sub_task_id)
+
+    async def release(self, grant, status, ext, **fields):
+        if execute_writer.enabled:
+            await Task.async_task_ready(task_key=grant.task_key)
+            execute_writer.put(grant.sub_task_id, extra=ext, status=status, **fields)
+            return True, None
+        return await Task.async_task_atomic_update(grant.task_key, grant.sub_task_id, status, ext, **fields)
+
+
+class RedisLockBackend:
+    def __init__(self, lease_ttl=60, renew_interval=20, alias='default'):
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.alias = alias
+
+    def make_lease(self, task_key):
+        return RedisLease('assassin:lock:{}'.format(task_key), self.lease_ttl,
+                          fence_key='assassin:fence:{}'.format(task_key), alias=self.alias)
+
+    async def acquire(self, task_key, trace_id):
+        lease = self.make_lease(task_key)
+        fence_token = await lease.acquire(trace_id)
+        if not fence_token:
+            return None
+        # 只有抢占成功的节点才写MySQL
+        try:
+            task_id, sub_task_id = await Task.async_task_fenced_insert(task_key, trace_id, fence_token)
+        except Exception:
+            logger.error({'panic_keyword': 'fenced_insert_err', 'err': traceback.format_exc(),
+                          'task_key': task_key, 'ip': ip})
+            await lease.release(trace_id)
+            return None
+        grant = LockGrant(task_key, trace_id, sub_task_id, task_id=task_id, fence_token=fence_token)
+        grant.lease = lease
+        grant.keeper = asyncio.ensure_future(self.keep_alive(grant))
+        return grant
+
+    async def keep_alive(self, grant):
+        """
+        长任务定期续约
+        """
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                if not await grant.lease.renew(grant.trace_id):
+                    logger.error({'panic_keyword': 'lease_lost', 'task_key': grant.task_key,
+                                  'fence_token': grant.fence_token, 'ip': ip})
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error({'panic_keyword': 'lease_renew_err', 'err': traceback.format_exc(),
+                              'task_key': grant.task_key, 'ip': ip})
+
+    async def release(self, grant, status, ext, **fields):
+        grant.keeper.cancel()
+        try:
+            if execute_writer.enabled:
+                await Task.async_task_ready(task_id=grant.task_id, fence_token=grant.fence_token)
+                execute_writer.put(grant.sub_task_id, extra=ext, status=status, **fields)
+                return True, None
+            return await Task.async_task_fenced_update(grant.task_id, grant.sub_task_id, status, ext,
+                                                       grant.fence_token, **fields)
+        finally:
+            try:
+                await grant.lease.release(grant.trace_id)
+            except Exception:
+                # 释放失败时等待租约自然过期
+                logger.error({'panic_keyword': 'lease_release_err', 'err': traceback.format_exc(),
+                              'task_key': grant.task_key, 'ip': ip})
+
+
+@lru_cache()
+def get_lock_backend():
+    """
+    根据配置获取锁实现(进程内单例)
+    """
+    lock_conf = ConfEntity().common.get('lock', {})
+    if lock_conf.get('backend', 'mysql') == 'redis':
+        return RedisLockBackend(lease_ttl=lock_conf.get('lease_ttl', 60),
+                                renew_interval=lock_conf.get('renew_interval', 20),
+                                alias=lock_conf.get('redis', 'default'))
+    return MysqlLockBackend()
@@ -0,0 +1,86 @@
+"""
+execute_task 历史数据归档
+按主键游标分批读取过期数据、追加写入 gzip NDJSON 文件之后按主键删除
+每批数据单独提交、不会长时间锁表
+"""
+import os
+import gzip
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+from peewee import fn
+
+from libs.logger import LoggerPool, NormalEncoder
+from libs.utils.other import Host
+from libs.utils.datekit import datetime_fmt
+from models.task import TaskExecute
+
+
+__all__ = [
+    'ExecuteArchiver',
+]
+
+ip = Host().host_ip()
+logger = LoggerPool.other
+
+
+class ExecuteArchiver:
+    """
+    >>> archiver = ExecuteArchiver('/data/logs/app/archive', chunk_size=1000)
+    >>> await archiver.archive(30)                          # 默认策略: 保留30天
+    >>> await archiver.archive(7, task_ids=[1, 2])          # 指定任务: 保留7天
+    """
+    def __init__(self, archive_dir, chunk_size=1000, pause=0.1):
+        self.archive_dir = archive_dir
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.filename = os.path.join(archive_dir, 'execute_task-{}.ndjson.gz'.format(
+            datetime_fmt(fmt='%Y%m%d%H%M%S')))
+
+    async def archive(self, days, task_ids=None, exclude_ids=None):
+        """
+        归档 create_at 早于 days 天之前的数据、返回归档条数
+        days <= 0 表示永久保留
+        """
+        if days <= 0:
+            return 0
+        cutoff = datetime.now() - timedelta(days=days)
+        loop = asyncio.get_event_loop()
+        objects = TaskExecute.async_objects
+        moved = 0
+        # 扫描范围的id上界(create_at索引)、之后按主键游标分批读取、跳过的数据不会被重复扫描
+        bound = list(await objects.execute(TaskExecute.select(fn.MAX(TaskExecute.id).alias('max_id')).
+                                           where(TaskExecute.create_at < cutoff).dicts()))
+        max_id = bound[0]['max_id'] if bound else None
+        last_id = 0
+        while max_id is not None and last_id < max_id:
+            query = TaskExecute.select().where(TaskExecute.id > last_id, TaskExecute.id <= max_id,
+                                               TaskExecute.create_at < cutoff)
+            if task_ids:
+                query = query.where(TaskExecute.task_id.in_(task_ids))
+            if exclude_ids:
+                query = query.where(TaskExecute.task_id.not_in(exclude_ids))
+            rows = list(await objects.execute(query.order_by(TaskExecute.id).limit(self.chunk_size).dicts()))
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            # 先落盘再删除、进程异常退出时最多产生重复归档
+            await loop.run_in_executor(None, self.write, rows)
+            await objects.execute(TaskExecute.delete().where(TaskExecute.id.in_([r['id'] for r in rows])))
+            moved += len(rows)
+            if len(rows) < self.chunk_size:
+                break
+            await asyncio.sleep(self.pause)
+        logger.info({'keyword': 'archive_execute_task', 'days': days, 'task_ids': task_ids,
+                     'moved': moved, 'file': self.filename, 'ip': ip})
+        return moved
+
+    def write(self, rows):
+        """
+        每批数据追加为一个独立的gzip member、gzip.open 可以直接顺序读取
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        lines = ''.join(json.dumps(row, ensure_ascii=False, cls=NormalEncoder) + '\n' for row in rows)
+        with gzip.open(self.filename, 'ab') as f:
+            f.write(lines.encode('utf-8'))
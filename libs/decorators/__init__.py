@@ -4,6 +4,8 @@ import threading
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
+from libs.utils.other import context_wrapper
+
 
 def try_catch(func):
     """
@@ -59,7 +61,8 @@ def singleton(cls):
 class AsyncModuleWrapper:
     """
     PS:
-    实现原理是多线程
+    实现原理是多线程、每个实例使用独立线程池(默认单线程、同一个模块的调用串行执行)
+    不与任务共享线程池(libs.utils.pool)、长时间阻塞的任务不会影响这里的调用
     建议直接使用原生异步的库函数、不要过度依赖该装饰器
 
     使用方法如下:
@@ -85,7 +88,5 @@ class AsyncModuleWrapper:
         return origin
 
     async def run(self, origin_func, *args, **kwargs):
-        def wrapper():
-            return origin_func(*args, **kwargs)
-
-        return await self.loop.run_in_executor(self.executor, wrapper)
+        # 线程里沿用当前上下文(trace_id)
+        return await self.loop.run_in_executor(self.executor, context_wrapper(origin_func, *args, **kwargs))
@@ -1,19 +1,32 @@
+import os
 import logging
 import logging.config
 import concurrent_log_handler
 import json
 import datetime
+import queue
+import threading
+import weakref
+import time
 from copy import deepcopy
 from functools import singledispatch
 
-from libs.utils.other import Host, get_trace_id_from_stack
+from libs.utils.other import Host, get_trace_id
 from libs.utils.datekit import now_timestamp, datetime_fmt
 from libs.tomlread import ConfEntity
 
 
 REMOVE_ATTR = ["module", "exc_text", "stack_info", "created", "msecs", "relativeCreated", "exc_info"]
+# FastJSONFormatter 输出的字段(与 LogRecord 属性顺序一致)
+FAST_ATTR = ("name", "msg", "args", "levelname", "levelno", "pathname", "filename", "lineno", "funcName",
+             "thread", "threadName", "processName", "process", "trace_id")
 MAX_BACK_DEPTH = 100
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 @singledispatch
 def json_decode(o):
@@ -84,18 +97,230 @@ class JSONFormatter(logging.Formatter):
 
     @classmethod
     def set_trace_id(cls, extra):
+        # 异步写日志时 trace_id 在入队时已经获取
+        if extra.get('trace_id') is not None:
+            return
         # 优先从日志参数里面获取
         trace_id = extra['msg'].get('__unique_trace_id__')
         if trace_id:
             extra['trace_id'] = trace_id
             return
         # 日志参数未找到trace_id
-        # 根据调用栈信息往前追溯、最多100层
-        trace_id = get_trace_id_from_stack()
+        # 从上下文获取、未设置时根据调用栈信息往前追溯、最多100层
+        trace_id = get_trace_id()
         if trace_id is not None:
             extra['trace_id'] = trace_id
 
 
+class FastJSONFormatter(JSONFormatter):
+    """
+    高吞吐版本的 JSONFormatter
+    1、只输出 FAST_ATTR 里的字段(logger.info(..., extra={}) 的自定义字段不会输出)
+    2、主机信息预先序列化、时间字段按秒缓存
+    3、安装了 orjson 时默认使用 orjson(输出无空格)、backend='json' 时与 JSONFormatter 输出完全一致
+    """
+    def __init__(self, fmt=None, datefmt=None, style='%', backend=None):
+        super(FastJSONFormatter, self).__init__(fmt, datefmt, style)
+        if backend is None:
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend == 'orjson':
+            self.dumps = self.orjson_dumps
+            self.item_sep, self.key_sep = ',', ':'
+        else:
+            self.dumps = NormalEncoder(ensure_ascii=False).encode
+            self.item_sep, self.key_sep = ', ', ': '
+        self.host_part = self.make_part('host_name', JSONFormatter.host_name) + \
+            self.make_part('host_ip', JSONFormatter.host_ip)
+        self.time_cache = (None, '')
+
+    @staticmethod
+    def orjson_dumps(o):
+        return orjson.dumps(o, default=json_decode, option=orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+
+    def make_part(self, key, value):
+        return self.item_sep + self.dumps(key) + self.key_sep + self.dumps(value)
+
+    def time_part(self):
+        now = int(time.time())
+        sec, part = self.time_cache
+        if sec != now:
+            part = self.make_part('timestamp', now) + \
+                self.make_part('time_fmt', datetime_fmt(datetime.datetime.fromtimestamp(now)))
+            self.time_cache = (now, part)
+        return part
+
+    def format(self, record):
+        attrs = record.__dict__
+        extra = {attr_name: attrs[attr_name] for attr_name in FAST_ATTR if attr_name in attrs}
+        msg = extra.get('msg')
+        if type(msg) is not dict:
+            msg = extra['msg'] = {'msg': msg}
+        extra['args'] = str(extra.get('args', ''))
+        tail = self.time_part() + self.host_part
+        if extra.get('trace_id') is None:
+            trace_id = msg.get('__unique_trace_id__') or get_trace_id()
+            if trace_id is not None:
+                if 'trace_id' in extra:
+                    extra['trace_id'] = trace_id
+                else:
+                    tail += self.make_part('trace_id', trace_id)
+        if record.exc_info:
+            tail += self.make_part('exc_info', self.formatException(record.exc_info))
+        return self.dumps(extra)[:-1] + tail + '}'
+
+
+class AsyncQueueHandler(logging.Handler):
+    """
+    异步写日志: 日志先进入有界队列、由后台线程批量格式化之后一次写入目标handler
+    overflow 队列满时的处理方式
+        block: 阻塞等待
+        drop-debug: 丢弃 drop_level 及以下级别的日志、其他级别阻塞等待
+        drop-oldest: 丢弃队列里最早的日志
+    后台线程在第一次写日志时启动、fork之后的子进程(接口服务worker)重新创建队列及线程
+    """
+    instances = weakref.WeakSet()
+
+    def __init__(self, target, maxsize=10000, overflow='block', drop_level='DEBUG', batch_size=256):
+        super(AsyncQueueHandler, self).__init__()
+        self.target = self.make_target(dict(target))
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.drop_level = logging.getLevelName(drop_level) if isinstance(drop_level, str) else drop_level
+        self.batch_size = batch_size
+        self.counters = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped_debug': 0,
+            'dropped_oldest': 0,
+            'write_errors': 0,
+        }
+        self._sentinel = object()
+        self._writer = None
+        # 后台线程所属进程
+        self._pid = None
+        self._start_lock = threading.Lock()
+        AsyncQueueHandler.instances.add(self)
+
+    def ensure_writer(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._writer = threading.Thread(target=self.run, name='log-writer', daemon=True)
+            self._writer.start()
+            self._pid = pid
+
+    def reset_after_fork(self):
+        """
+        子进程没有继承父进程的后台线程、父进程队列里的日志由父进程写入
+        继承的队列/锁可能处于加锁状态、全部重新创建
+        """
+        self.queue = queue.Queue(self.maxsize)
+        self._start_lock = threading.Lock()
+        self._writer = None
+        self._pid = None
+
+    @staticmethod
+    def make_target(conf):
+        conf.pop('formatter', None)
+        conf.pop('level', None)
+        klass = logging.config.BaseConfigurator({}).resolve(conf.pop('class'))
+        target = klass(**conf)
+        # 批量写入的内容已经格式化完毕
+        target.setFormatter(logging.Formatter('%(message)s'))
+        return target
+
+    def emit(self, record):
+        # 写日志的线程/协程里获取trace_id、后台线程无法通过调用栈获取
+        if getattr(record, 'trace_id', None) is None:
+            msg = record.msg if isinstance(record.msg, dict) else {}
+            record.trace_id = msg.get('__unique_trace_id__') or get_trace_id()
+        self.ensure_writer()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if not self.handle_overflow(record):
+                return
+        self.counters['enqueued'] += 1
+
+    def handle_overflow(self, record):
+        """
+        队列已满、返回是否已入队
+        """
+        if self.overflow == 'drop-debug' and record.levelno <= self.drop_level:
+            self.counters['dropped_debug'] += 1
+            return False
+        if self.overflow == 'drop-oldest':
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    self.counters['dropped_oldest'] += 1
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(record)
+                    return True
+                except queue.Full:
+                    continue
+        self.queue.put(record)
+        return True
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._sentinel in batch
+            self.write([r for r in batch if r is not self._sentinel])
+            if stop:
+                return
+
+    def write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.counters['write_errors'] += 1
+        if not lines:
+            return
+        merged = logging.makeLogRecord({'msg': self.target.terminator.join(lines),
+                                        'levelno': logging.CRITICAL, 'levelname': 'CRITICAL'})
+        try:
+            self.target.handle(merged)
+            self.counters['written'] += len(lines)
+        except Exception:
+            self.counters['write_errors'] += len(lines)
+
+    def stats(self):
+        rst = dict(self.counters)
+        rst['queue_depth'] = self.queue.qsize()
+        rst['dropped'] = rst['dropped_debug'] + rst['dropped_oldest']
+        return rst
+
+    def close(self):
+        if self._writer is not None and self._pid == os.getpid() and self._writer.is_alive():
+            self.queue.put(self._sentinel)
+            self._writer.join(timeout=5)
+        self.target.close()
+        super(AsyncQueueHandler, self).close()
+
+
+def reset_queue_handlers():
+    for handler in list(AsyncQueueHandler.instances):
+        handler.reset_after_fork()
+
+
+# tornado.process.fork_processes 之前已经配置了日志(web.api 导入 libs.logger)
+os.register_at_fork(after_in_child=reset_queue_handlers)
+
+
 class LoggerConf:
     def __init__(self, basic_conf=None):
         if isinstance(basic_conf, dict):
@@ -113,6 +338,10 @@ class LoggerConf:
             'formatters': {
                 'json': {
                     'class': 'logger.JSONFormatter'
+                },
+                # 高吞吐版本、logger.toml 里配置 formatter = "json_fast" 使用
+                'json_fast': {
+                    'class': 'logger.FastJSONFormatter'
                 }
             },
             # 处理器集合(配置文件读取)
@@ -164,9 +393,30 @@ class LoggerConf:
         cnf = ConfEntity().logger
         return cnf
 
+    @staticmethod
+    def read_queue_conf():
+        return ConfEntity().common.get('log_queue', {})
+
+    @staticmethod
+    def make_queue_handler(basic_handler, queue_conf):
+        """
+        异步写日志: 原handler作为后台线程的写入目标
+        """
+        return {
+            '()': AsyncQueueHandler,
+            'level': basic_handler['level'],
+            'formatter': basic_handler['formatter'],
+            'target': basic_handler,
+            'maxsize': queue_conf.get('maxsize', 10000),
+            'overflow': queue_conf.get('overflow', 'block'),
+            'drop_level': queue_conf.get('drop_level', 'DEBUG'),
+            'batch_size': queue_conf.get('batch_size', 256),
+        }
+
     def make_full_conf(self):
         basic = self.__basic_conf
         toml = self.read_toml()
+        queue_conf = self.read_queue_conf()
         for handler, conf in toml.items():
             basic_handler = self.cpy_handler
             basic_logger = self.cpy_logger
@@ -174,6 +424,8 @@ class LoggerConf:
             basic_logger['handlers'].append(handler)
             if conf.get('level'):
                 basic_logger['level'] = conf['level']
+            if queue_conf.get('enabled'):
+                basic_handler = self.make_queue_handler(basic_handler, queue_conf)
             basic['handlers'][handler] = basic_handler
             basic['loggers'][handler] = basic_logger
         return basic
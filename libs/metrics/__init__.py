@@ -0,0 +1,163 @@
+"""
+进程内指标(Prometheus 文本格式)
+指标按 label 值的元组保存、打点只有一次dict查找和加法、不加锁(只在事件循环线程中打点)
+"""
+import bisect
+import math
+import traceback
+
+from libs.logger import LoggerPool
+
+logger = LoggerPool.other
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'registry',
+    'render',
+]
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('metric <{}> is already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        registry.register(self)
+
+    def label_str(self, values, extra=''):
+        pairs = ['{}="{}"'.format(k, escape(v)) for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    >>> LOCK_TOTAL = Counter('assassin_lock_total', '抢锁次数', ['result'])
+    >>> LOCK_TOTAL.inc('get_lock')
+    """
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        super(Counter, self).__init__(name, doc, labels)
+        self.values = {}
+
+    def inc(self, *labels, value=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + value
+
+    def samples(self):
+        return ['{}{} {}'.format(self.name, self.label_str(k), format_value(v)) for k, v in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """
+    >>> LEADER = Gauge('assassin_leader', '当前节点是否为leader', fn=lambda: elector.is_leader)
+    >>> QUEUE = Gauge('assassin_queue', '队列长度')
+    >>> QUEUE.set(10)
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), fn=None):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.values = {}
+        # 采集时调用、适合读取已有的统计数据
+        self.fn = fn
+        # fn 异常只纪录一次日志、避免每次采集都刷日志
+        self.fn_failed = False
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        values = dict(self.values)
+        if self.fn is not None:
+            try:
+                values[()] = float(self.fn())
+            except Exception:
+                # 跳过该样本
+                if not self.fn_failed:
+                    self.fn_failed = True
+                    logger.error({'panic_keyword': 'metrics_gauge_err', 'name': self.name,
+                                  'err': traceback.format_exc()})
+        return ['{}{} {}'.format(self.name, self.label_str(k), format_value(v)) for k, v in values.items()]
+
+
+class Histogram(Metric):
+    """
+    >>> TASK_DURATION = Histogram('assassin_task_duration_seconds', '任务执行时长', ['task_key'])
+    >>> TASK_DURATION.observe(0.35, 'task_key')
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label值 -> [各区间计数..., +Inf区间计数, sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [0] * (len(self.buckets) + 2)
+        item[bisect.bisect_left(self.buckets, value)] += 1
+        item[-1] += value
+
+    def samples(self):
+        lines = []
+        for labels, item in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), item[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self.label_str(labels, 'le="{}"'.format(
+                    format_value(bound))), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.label_str(labels), format_value(item[-1])))
+            lines.append('{}_count{} {}'.format(self.name, self.label_str(labels), cumulative))
+        return lines
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,48 @@
+"""
+调度进程指标端口
+调度进程没有web框架、使用 asyncio.start_server 响应 GET /metrics
+"""
+import asyncio
+import traceback
+
+from libs.logger import LoggerPool
+from libs.metrics import render
+
+logger = LoggerPool.other
+
+__all__ = [
+    'start_metrics_server',
+]
+
+
+async def handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # 丢弃请求头
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+    except Exception:
+        logger.error({'panic_keyword': 'metrics_server_err', 'err': traceback.format_exc()})
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host='0.0.0.0', port=9108):
+    """
+    >>> loop.run_until_complete(start_metrics_server(port=9108))
+    >>> curl http://127.0.0.1:9108/metrics
+    """
+    server = await asyncio.start_server(handle, host, port)
+    logger.info({'keyword': 'metrics_server_start', 'host': host, 'port': port})
+    return server
@@ -0,0 +1,68 @@
+"""
+基于 Redis 的租约(lease)
+SET NX PX 抢占、到期自动释放；续约/释放时校验持有者、防止误删他人的租约
+"""
+from libs.redis import redis_pools
+
+
+__all__ = [
+    'RedisLease'
+]
+
+
+# KEYS[1]: 租约key  KEYS[2]: fencing token计数器(可选)
+# ARGV[1]: 持有者  ARGV[2]: 租约时长(ms)
+ACQUIRE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    if #KEYS > 1 then
+        return redis.call('INCR', KEYS[2])
+    end
+    return 1
+end
+return 0
+"""
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLease:
+    """
+    >>> lease = RedisLease('assassin:lock:test', ttl=30, fence_key='assassin:fence:test')
+    >>> token = await lease.acquire('owner-1')    # 抢占成功返回递增的fencing token、失败返回0
+    >>> await lease.renew('owner-1')
+    >>> await lease.release('owner-1')
+    """
+    def __init__(self, key, ttl, fence_key=None, alias='default'):
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        self.fence_key = fence_key
+        self.alias = alias
+
+    async def acquire(self, owner):
+        rds = await redis_pools(self.alias)
+        keys = [self.key, self.fence_key] if self.fence_key else [self.key]
+        return int(await rds.eval(ACQUIRE_SCRIPT, keys=keys, args=[owner, self.ttl_ms]) or 0)
+
+    async def renew(self, owner):
+        rds = await redis_pools(self.alias)
+        return bool(await rds.eval(RENEW_SCRIPT, keys=[self.key], args=[owner, self.ttl_ms]))
+
+    async def release(self, owner):
+        rds = await redis_pools(self.alias)
+        return bool(await rds.eval(RELEASE_SCRIPT, keys=[self.key], args=[owner]))
+
+    async def owner(self):
+        rds = await redis_pools(self.alias)
+        return await rds.get(self.key, encoding='utf-8')
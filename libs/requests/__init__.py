@@ -1,22 +1,40 @@
 import json
+import random
+import asyncio
 import traceback
 from itertools import chain
+from collections import namedtuple
 import urllib.parse
 
 import aiohttp
 import requests
 
 from libs.logger import LoggerPool
-from libs.utils.other import get_trace_id_from_stack
+from libs.tomlread import ConfEntity
+from libs.utils.other import get_trace_id
+from .session import SessionPool
+from .circuit import CircuitBreaker, CircuitOpenError
+from .cache import response_cache
 
 logger = LoggerPool.root
 SPECIAL_ATTRS = ('__query__', '__data__', '__json__', '__path1__')
+batch_conf = ConfEntity().common.get('http_batch', {})
+
+# 批量请求单个结果: 成功时 error 为None
+FetchResult = namedtuple('FetchResult', ['server', 'error'])
 
 
 class SpecialEmpty(object):
     pass
 
 
+class HttpStatusError(Exception):
+    def __init__(self, status, url):
+        super(HttpStatusError, self).__init__('http status {} with url {}'.format(status, url))
+        self.status = status
+        self.url = url
+
+
 class Field(object):
     def __init__(self, default, required):
         self.default = default
@@ -125,6 +143,16 @@ class BaseServer(SpecialEmpty, dict, object, metaclass=RequestMetaClass):
     def _set_method(self):
         self._method = self.METHOD.lower()
 
+    def _get_session(self):
+        """
+        按 __HOST__ 共享连接池、子类可以通过 POOL_* 属性单独配置
+        """
+        return SessionPool.get(self.__HOST__,
+                               limit=getattr(self, 'POOL_LIMIT', None),
+                               limit_per_host=getattr(self, 'POOL_LIMIT_PER_HOST', None),
+                               keepalive_timeout=getattr(self, 'POOL_KEEPALIVE_TIMEOUT', None),
+                               ttl_dns_cache=getattr(self, 'POOL_DNS_CACHE_TTL', None))
+
     def new_server(self):
         self._data, self._query, self._json, self._path1 = {}, {}, {}, {}
         for attr in SPECIAL_ATTRS:
@@ -167,15 +195,16 @@ class BaseServer(SpecialEmpty, dict, object, metaclass=RequestMetaClass):
             return self
 
     async def async_fetch(self, transmit_err=True):
-        __unique_trace_id__ = get_trace_id_from_stack()
+        __unique_trace_id__ = get_trace_id()
         try:
-            async with aiohttp.ClientSession() as session:
-                handle = getattr(session, self._method)
-                timeout = aiohttp.ClientTimeout(total=self._timeout)
-                async with handle(url=self._url, timeout=timeout, headers=self._header, **self._req_map) as response:
-                    self._fetch_url = response.url
-                    self._response = await response.text()
-                return self
+            ttl = self._cache_ttl()
+            if ttl:
+                item = await response_cache.get_or_fetch(self._cache_key(), ttl, self._async_request,
+                                                         redis_alias=getattr(self, 'CACHE_REDIS', None))
+            else:
+                item = await self._async_request()
+            self._fetch_url, self._status, self._response = item['url'], item['status'], item['body']
+            return self
         except Exception as e:
             logger.error({'panic_keyword': '_async_fetch_err', 'err': traceback.format_exc(),
                           'url': self._url, 'fetch_url': self._fetch_url, 'data': self._data,
@@ -185,6 +214,111 @@ class BaseServer(SpecialEmpty, dict, object, metaclass=RequestMetaClass):
                 raise e
             return self
 
+    async def _async_request(self):
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=self._timeout)
+        async with session.request(self._method, self._url, timeout=timeout, headers=self._header,
+                                   **self._req_map) as response:
+            return {'status': response.status, 'url': str(response.url), 'body': await response.text()}
+
+    def _cache_ttl(self):
+        """
+        只缓存声明了 CACHE_TTL 的GET请求
+        """
+        ttl = getattr(self, 'CACHE_TTL', None)
+        if not ttl or self._method != 'get':
+            return None
+        return ttl
+
+    def _cache_key(self):
+        """
+        缓存key: method + url + 排序之后的query参数
+        """
+        query = urllib.parse.urlencode(sorted((k, str(v)) for k, v in self._query.items() if v is not None))
+        return '{}:{}?{}'.format(self._method, self._url, query)
+
+    def _retry_policy(self, **overrides):
+        """
+        重试/熔断配置: batch_fetch参数 > 子类 RETRY_*/CIRCUIT_* 属性 > common.toml [http_batch]
+        """
+        policy = {
+            'retries': getattr(self, 'RETRY_TIMES', None),
+            'retry_status': getattr(self, 'RETRY_STATUS', None),
+            'retry_exceptions': getattr(self, 'RETRY_EXCEPTIONS', None),
+            'backoff': getattr(self, 'RETRY_BACKOFF', None),
+            'backoff_max': getattr(self, 'RETRY_BACKOFF_MAX', None),
+            'circuit_threshold': getattr(self, 'CIRCUIT_THRESHOLD', None),
+            'circuit_recovery': getattr(self, 'CIRCUIT_RECOVERY', None),
+        }
+        policy.update({k: v for k, v in overrides.items() if v is not None})
+        defaults = {
+            'retries': batch_conf.get('retries', 2),
+            'retry_status': tuple(batch_conf.get('retry_status', [502, 503, 504])),
+            'retry_exceptions': (aiohttp.ClientError, asyncio.TimeoutError),
+            'backoff': batch_conf.get('backoff', 0.2),
+            'backoff_max': batch_conf.get('backoff_max', 5),
+            'circuit_threshold': batch_conf.get('circuit_threshold', 5),
+            'circuit_recovery': batch_conf.get('circuit_recovery', 30),
+        }
+        return {k: defaults[k] if v is None else v for k, v in policy.items()}
+
+    async def _async_fetch_retry(self, **overrides):
+        """
+        带重试及熔断的 async_fetch
+        重试间隔为 [0, min(backoff_max, backoff * 2^n)] 之间的随机值、避免多个请求同时重试
+        """
+        policy = self._retry_policy(**overrides)
+        breaker = CircuitBreaker.get(self.__HOST__, policy['circuit_threshold'], policy['circuit_recovery'])
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError('circuit of host {} is open'.format(self.__HOST__))
+            try:
+                await self.async_fetch()
+                if self._status in policy['retry_status']:
+                    raise HttpStatusError(self._status, self._url)
+            except (HttpStatusError, ) + tuple(policy['retry_exceptions']) as e:
+                breaker.failure()
+                if attempt >= policy['retries']:
+                    raise e
+                delay = random.uniform(0, min(policy['backoff_max'], policy['backoff'] * 2 ** attempt))
+                attempt += 1
+                logger.info({'keyword': '_async_fetch_retry', 'url': self._url, 'attempt': attempt,
+                             'delay': round(delay, 3), 'err': repr(e)})
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                # 非重试异常(参数错误等)不代表后端故障、不计入熔断
+                breaker.probing = False
+                raise
+            breaker.success()
+            return self
+
+    @classmethod
+    async def batch_fetch(cls, servers, concurrency=None, **overrides):
+        """
+        并发执行多个已经 new_server() 的请求
+        concurrency 限制同时进行的请求数、结果与 servers 顺序一致、单个请求失败不影响其他请求
+        overrides 可以覆盖重试及熔断配置: retries/retry_status/retry_exceptions/backoff/backoff_max/
+        circuit_threshold/circuit_recovery
+        >>> results = await ReqTest.batch_fetch([ReqTest(name=n).new_server() for n in names], concurrency=10)
+        >>> [r.server.json() for r in results if r.error is None]
+        """
+        concurrency = concurrency or getattr(cls, 'BATCH_CONCURRENCY', None) or batch_conf.get('concurrency', 10)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(server):
+            async with semaphore:
+                try:
+                    await server._async_fetch_retry(**overrides)
+                    return FetchResult(server, None)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    return FetchResult(server, e)
+
+        return await asyncio.gather(*[run(server) for server in servers])
+
     def json(self, safe=True):
         try:
             return json.loads(self._response)
@@ -199,6 +333,9 @@ class BaseServer(SpecialEmpty, dict, object, metaclass=RequestMetaClass):
     def content(self):
         return self._response
 
+    def status(self):
+        return self._status
+
 
 """EXAMPLE
 from . import BaseServer, DataField, QueryField, JsonField
@@ -206,6 +343,25 @@ from . import BaseServer, DataField, QueryField, JsonField
 class BackendServer(BaseServer):
     __HOST__ = 'http://www.test.com'
     TIMEOUT = 5  # 默认为5s
+    # 连接池配置(可选、默认读取 common.toml [http_pool])
+    POOL_LIMIT = 100
+    POOL_LIMIT_PER_HOST = 20
+    POOL_KEEPALIVE_TIMEOUT = 15
+    POOL_DNS_CACHE_TTL = 10
+    # 批量请求配置(可选、默认读取 common.toml [http_batch])
+    BATCH_CONCURRENCY = 10
+    RETRY_TIMES = 2
+    RETRY_STATUS = (502, 503, 504)
+    CIRCUIT_THRESHOLD = 5
+    CIRCUIT_RECOVERY = 30
+
+class ReqConf(BackendServer):
+    # 幂等的GET请求可以声明 CACHE_TTL(s) 缓存响应、CACHE_REDIS 为可选的redis别名(多节点共享缓存)
+    URL = '/test/api/conf'
+    METHOD = 'get'
+    CACHE_TTL = 60
+    CACHE_REDIS = 'default'
+    query_name = QueryField('')
 
 class ReqTest(BackendServer):
     URL = '/test/api/get/{path_score}'
@@ -227,4 +383,7 @@ if __name__ == '__main__':
 
     resp_with_json = resp_sync.json()
     resp_with_json = resp_async.json()
+
+    results = await ReqTest.batch_fetch([ReqTest(name=n).new_server() for n in ('n1', 'n2')], concurrency=2)
+    resp_with_json = [r.server.json() if r.error is None else {} for r in results]
 """
@@ -0,0 +1,113 @@
+"""
+BaseServer GET请求响应缓存
+一级为进程内LRU、并发未命中的相同请求只请求一次(single-flight)
+二级为可选的Redis缓存、多个节点共享命中结果
+"""
+import json
+import time
+import asyncio
+import hashlib
+import traceback
+
+from libs.tomlread import ConfEntity
+from libs.logger import LoggerPool
+from libs.redis import redis_pools
+from libs.utils.cache import TTLCache
+
+logger = LoggerPool.root
+cache_conf = ConfEntity().common.get('http_cache', {})
+
+__all__ = [
+    'ResponseCache',
+    'response_cache',
+]
+
+
+class LoaderCancelled(Exception):
+    """
+    发起请求的协程被取消、不把取消传递给其他等待者
+    """
+    pass
+
+
+class ResponseCache:
+    """
+    >>> item = await response_cache.get_or_fetch('get:http://www.test.com/api?a=1', 30, loader, redis_alias='default')
+    >>> item
+    {'status': 200, 'url': 'http://www.test.com/api?a=1', 'body': '...', 'expire_at': 1590000000.0}
+    """
+    def __init__(self, maxsize=1024, prefix='assassin:http_cache:'):
+        self.local = TTLCache(maxsize=maxsize)
+        self.prefix = prefix
+        self.inflight = {}
+
+    async def get_or_fetch(self, key, ttl, loader, redis_alias=None):
+        while True:
+            item = self.local.get(key)
+            if item is not None:
+                return item
+            # 相同key已经在请求中、等待其结果
+            future = self.inflight.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except LoaderCancelled:
+                # 发起请求的协程被取消、由第一个等待者重新发起请求
+                continue
+        future = self.inflight[key] = asyncio.get_event_loop().create_future()
+        try:
+            item = await self.load(key, ttl, loader, redis_alias)
+        except BaseException as e:
+            future.set_exception(LoaderCancelled(key) if isinstance(e, asyncio.CancelledError) else e)
+            # 没有等待者时避免 "exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(item)
+        finally:
+            self.inflight.pop(key, None)
+        return item
+
+    async def load(self, key, ttl, loader, redis_alias=None):
+        rkey = self.prefix + hashlib.md5(key.encode('utf-8')).hexdigest()
+        if redis_alias:
+            item = await self.redis_get(redis_alias, rkey)
+            if item is not None:
+                self.local.set(key, item, ttl=item['expire_at'] - time.time())
+                return item
+        item = await loader()
+        # 只缓存成功的响应
+        if item['status'] < 400:
+            item['expire_at'] = time.time() + ttl
+            self.local.set(key, item, ttl=ttl)
+            if redis_alias:
+                await self.redis_set(redis_alias, rkey, item, ttl)
+        return item
+
+    @staticmethod
+    async def redis_get(alias, rkey):
+        """
+        Redis异常时降级为直接请求
+        """
+        try:
+            rds = await redis_pools(alias)
+            value = await rds.get(rkey, encoding='utf-8')
+            return json.loads(value) if value else None
+        except Exception:
+            logger.error({'panic_keyword': 'http_cache_redis_get_err', 'err': traceback.format_exc(), 'key': rkey})
+
+    @staticmethod
+    async def redis_set(alias, rkey, item, ttl):
+        try:
+            rds = await redis_pools(alias)
+            await rds.set(rkey, json.dumps(item), pexpire=int(ttl * 1000))
+        except Exception:
+            logger.error({'panic_keyword': 'http_cache_redis_set_err', 'err': traceback.format_exc(), 'key': rkey})
+
+    def clear(self):
+        self.local.clear()
+
+
+response_cache = ResponseCache(maxsize=cache_conf.get('maxsize', 1024),
+                               prefix=cache_conf.get('prefix', 'assassin:http_cache:'))
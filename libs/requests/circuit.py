@@ -0,0 +1,85 @@
+"""
+按host维度的熔断器
+连续失败达到阈值之后熔断(open)、熔断期间直接失败不再请求后端
+冷却时间结束之后放行一个探测请求(half_open)、成功则恢复(closed)、失败则继续熔断
+"""
+import time
+
+from libs.logger import LoggerPool
+
+logger = LoggerPool.root
+
+__all__ = [
+    'CircuitBreaker',
+    'CircuitOpenError',
+]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    >>> breaker = CircuitBreaker.get('http://www.test.com', threshold=5, recovery=30)
+    >>> if not breaker.allow():
+    >>>     raise CircuitOpenError(breaker.name)
+    >>> breaker.success()  # 或 breaker.failure()
+    """
+    breakers = {}
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold=5, recovery=30):
+        self.name = name
+        self.threshold = threshold
+        self.recovery = recovery
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    @classmethod
+    def get(cls, name, threshold=5, recovery=30):
+        """
+        按 (host, threshold, recovery) 区分熔断器、不同调用方的熔断参数互不覆盖
+        """
+        key = (name, threshold, recovery)
+        breaker = cls.breakers.get(key)
+        if breaker is None:
+            breaker = cls.breakers[key] = cls(name, threshold, recovery)
+        return breaker
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery:
+                return False
+            self.set_state(self.HALF_OPEN)
+        # half_open 同一时间只放行一个探测请求
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != self.CLOSED:
+            self.set_state(self.CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self.set_state(self.OPEN)
+
+    def set_state(self, state):
+        logger.info({'keyword': 'circuit_breaker_state', 'name': self.name, 'threshold': self.threshold,
+                     'recovery': self.recovery, 'from': self.state, 'to': state, 'failures': self.failures})
+        self.state = state
@@ -0,0 +1,89 @@
+"""
+进程内共享的 aiohttp.ClientSession
+按 __HOST__ + 连接池配置区分、复用TCP/TLS连接(keepalive)及DNS缓存
+"""
+import asyncio
+import threading
+
+import aiohttp
+
+from libs.tomlread import ConfEntity
+
+
+__all__ = [
+    'SessionPool',
+    'close_sessions',
+]
+
+pool_conf = ConfEntity().common.get('http_pool', {})
+
+
+class SessionPool:
+    """
+    session 与事件循环绑定、按 事件循环 + host + 配置 缓存
+    >>> session = SessionPool.get('https://oapi.dingtalk.com', limit=100, limit_per_host=10)
+    >>> await close_sessions()    # 程序退出前关闭
+    """
+    sessions = {}
+    # 线程池中的任务同样会获取session
+    lock = threading.Lock()
+
+    # 默认连接池配置、BaseServer 子类可以通过 POOL_* 属性覆盖
+    defaults = {
+        'limit': pool_conf.get('limit', 100),
+        'limit_per_host': pool_conf.get('limit_per_host', 0),
+        'keepalive_timeout': pool_conf.get('keepalive_timeout', 15),
+        'ttl_dns_cache': pool_conf.get('dns_cache_ttl', 10),
+    }
+
+    @classmethod
+    def get(cls, host, **settings):
+        conf = dict(cls.defaults)
+        conf.update({k: v for k, v in settings.items() if v is not None})
+        loop = asyncio.get_event_loop()
+        key = (loop, host, tuple(sorted(conf.items())))
+        with cls.lock:
+            cls.purge()
+            session = cls.sessions.get(key)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(**conf)
+                session = cls.sessions[key] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    @classmethod
+    def purge(cls):
+        """
+        清理已关闭的事件循环上的session(调用方需持有lock)
+        """
+        for key in [key for key in cls.sessions if key[0].is_closed()]:
+            cls.discard(cls.sessions.pop(key))
+
+    @staticmethod
+    def discard(session):
+        """
+        所属事件循环已关闭、无法 await session.close()、直接关闭连接
+        """
+        connector = session.connector
+        session.detach()
+        if connector is not None:
+            try:
+                connector.close()
+            except Exception:
+                pass
+
+    @classmethod
+    async def close(cls):
+        loop = asyncio.get_event_loop()
+        with cls.lock:
+            sessions, cls.sessions = list(cls.sessions.items()), {}
+        for key, session in sessions:
+            if session.closed:
+                continue
+            if key[0] is loop:
+                await session.close()
+            else:
+                cls.discard(session)
+
+
+async def close_sessions():
+    await SessionPool.close()
@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    进程内LRU缓存、每个key单独计算过期时间
+    >>> cache = TTLCache(maxsize=1024, ttl=30)
+    >>> cache.set('key', 'value')
+    >>> cache.get('key')
+    >>> 'value'
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        value, expire_at = item
+        if expire_at < time.monotonic():
+            self.data.pop(key, None)
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.data)
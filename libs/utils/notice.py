@@ -1,10 +1,197 @@
-from libs.requests.ding_requests import DingDingAlarm
+import time
+import asyncio
+import traceback
+from collections import deque
+
+from libs.requests import HttpStatusError
+from libs.requests.ding_requests import DingDingAlarm, ding_ding_dict
+from libs.tomlread import ConfEntity
+from libs.logger import LoggerPool
+from libs.utils.other import Environ
+from libs.utils.outbox import AlertOutbox
+from libs.metrics import Counter, Histogram
+
+logger = LoggerPool.other
+alert_conf = ConfEntity().common.get('alert', {})
+alarm_counter = Counter('assassin_alarm_total', '报警条数')
+alarm_latency = Histogram('assassin_alarm_send_seconds', '报警汇总消息发送耗时', ['result'])
+
+
+class DingDingError(Exception):
+    pass
+
+
+class AlertConfigError(Exception):
+    """
+    报警配置错误(如缺少access_token)、重试也不会成功、AlertDispatcher 不做退避重试
+    """
+    pass
+
+
+def ding_access_token():
+    """
+    钉钉机器人access_token: 环境变量 DING_ACCESS_TOKEN 优先、其次 common.toml [ding].access_token
+    """
+    return Environ().DING_ACCESS_TOKEN or ding_ding_dict.get('access_token') or None
+
+
+def check_ding_conf():
+    """
+    程序启动时检查一次钉钉配置、缺少access_token时所有报警都无法发送
+    """
+    if ding_access_token():
+        return True
+    logger.error({'panic_keyword': 'ding_access_token_missing',
+                  'err': 'set common.toml [ding].access_token or env DING_ACCESS_TOKEN, alarms will be dropped'})
+    return False
 
 
 async def ding_ding_notice(msg):
+    """
+    发送失败时抛出异常(由 AlertDispatcher 退避重试)、缺少access_token时抛出 AlertConfigError
+    钉钉限流/参数错误时http状态码同样为200、需要同时检查 errcode
+    """
+    access_token = ding_access_token()
+    if not access_token:
+        raise AlertConfigError('ding access_token is not configured')
     text = {
         'content': 'ALARM: {}'.format(msg)
     }
-    server = DingDingAlarm(text=text).new_server()
+    server = DingDingAlarm(access_token=access_token, text=text).new_server()
     rsp = await server.async_fetch()
-    return rsp.json()
+    status = rsp.status()
+    if status is None or not 200 <= status < 300:
+        raise HttpStatusError(status, server._url)
+    body = rsp.json(safe=False)
+    errcode = body.get('errcode') if isinstance(body, dict) else None
+    if errcode != 0:
+        raise DingDingError('ding ding errcode: {}, rsp: {}'.format(errcode, rsp.content()))
+    return body
+
+
+class AlertDispatcher:
+    """
+    报警聚合发送
+    报警先写入本地持久化队列(AlertOutbox)之后立即返回、由后台协程每个窗口聚合发送一次
+    同一窗口内的报警按指纹(task_key + 错误类型)去重计数、超过全局频率限制时保留到下个窗口
+    发送失败按指数退避重试、程序重启之后继续发送未成功的报警、配置错误(AlertConfigError)时写入日志之后丢弃
+    >>> alert_dispatcher.notify('执行任务tk异常: xxx', task_key='tk', err_type='ValueError')
+    >>> alert_dispatcher.ensure_running()   # 程序启动时发送上次退出前未成功的报警
+    >>> await alert_dispatcher.close()      # 程序退出前尝试发送剩余报警
+    """
+    def __init__(self, outbox, window=60, rate_limit=20, max_items=50, max_length=500, backoff=5, backoff_max=600,
+                 max_age=86400, sender=ding_ding_notice):
+        self.outbox = outbox
+        self.window = window
+        # 每分钟最多发送的消息数
+        self.rate_limit = rate_limit
+        self.max_items = max_items
+        self.max_length = max_length
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        # 超过max_age(s)仍未发送成功的报警直接丢弃
+        self.max_age = max_age
+        self.sender = sender
+        self.sent_at = deque()
+        self.failures = 0
+        self.retry_at = 0
+        self.task = None
+
+    def notify(self, msg, task_key=None, err_type=None):
+        """
+        写入本地队列之后立即返回、不等待发送
+        """
+        alarm_counter.inc()
+        try:
+            self.outbox.put(msg, task_key=task_key, err_type=err_type)
+        except Exception:
+            logger.error({'panic_keyword': 'alert_outbox_put_err', 'err': traceback.format_exc(), 'msg': msg})
+        self.ensure_running()
+
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception:
+                logger.error({'panic_keyword': 'alert_flush_err', 'err': traceback.format_exc()})
+
+    def allow(self):
+        now = time.monotonic()
+        while self.sent_at and now - self.sent_at[0] > 60:
+            self.sent_at.popleft()
+        return len(self.sent_at) < self.rate_limit
+
+    async def flush(self, force=False):
+        if not force and time.monotonic() < self.retry_at:
+            return
+        expired = self.outbox.expire(self.max_age)
+        if expired:
+            logger.error({'panic_keyword': 'alert_expired', 'count': expired})
+        max_id, items = self.outbox.pending()
+        if not items:
+            return
+        if not self.allow():
+            logger.info({'keyword': 'alert_rate_limited', 'pending': len(items)})
+            return
+        self.sent_at.append(time.monotonic())
+        digest = self.digest(items)
+        begin = time.perf_counter()
+        try:
+            await self.sender(digest)
+        except AlertConfigError:
+            alarm_latency.observe(time.perf_counter() - begin, 'fail')
+            # 配置错误重试也不会成功、报警内容写入日志之后丢弃、避免本地队列无限增长
+            logger.error({'panic_keyword': 'alert_dropped', 'err': traceback.format_exc(), 'count': len(items),
+                          'digest': digest})
+            self.outbox.ack(max_id)
+            return
+        except Exception:
+            alarm_latency.observe(time.perf_counter() - begin, 'fail')
+            # 发送失败、保留在队列中按指数退避重试
+            self.failures += 1
+            delay = min(self.backoff_max, self.backoff * 2 ** (self.failures - 1))
+            self.retry_at = time.monotonic() + delay
+            logger.error({'panic_keyword': 'alert_send_err', 'err': traceback.format_exc(), 'pending': len(items),
+                          'failures': self.failures, 'retry_in': delay})
+            return
+        alarm_latency.observe(time.perf_counter() - begin, 'success')
+        self.failures, self.retry_at = 0, 0
+        self.outbox.ack(max_id)
+
+    def digest(self, items):
+        total = sum(item['count'] for item in items)
+        lines = ['assassin报警汇总(共{}条、{}类)'.format(total, len(items))]
+        for item in items[:self.max_items]:
+            msg = item['msg'] if len(item['msg']) <= self.max_length else item['msg'][:self.max_length] + '...'
+            if item['count'] > 1:
+                lines.append('[x{} 最近{}] {}'.format(item['count'],
+                                                    time.strftime('%H:%M:%S', time.localtime(item['last_at'])), msg))
+            else:
+                lines.append(msg)
+        if len(items) > self.max_items:
+            lines.append('其余{}类报警已省略'.format(len(items) - self.max_items))
+        return '\n'.join(lines)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        try:
+            await self.flush(force=True)
+        except Exception:
+            logger.error({'panic_keyword': 'alert_flush_err', 'err': traceback.format_exc()})
+        self.outbox.close()
+
+
+alert_dispatcher = AlertDispatcher(AlertOutbox(alert_conf.get('outbox', '/data/logs/app/alert_outbox.db')),
+                                   window=alert_conf.get('window', 60),
+                                   rate_limit=alert_conf.get('rate_limit', 20),
+                                   max_items=alert_conf.get('max_items', 50),
+                                   max_length=alert_conf.get('max_length', 500),
+                                   backoff=alert_conf.get('backoff', 5),
+                                   backoff_max=alert_conf.get('backoff_max', 600),
+                                   max_age=alert_conf.get('max_age', 86400))
@@ -5,9 +5,14 @@ import hashlib
 import time
 import random
 import sys
+from contextvars import ContextVar, copy_context
 from functools import lru_cache
 from configparser import ConfigParser
 
+# 当前执行任务的trace_id(由lock装饰器设置)
+# 每个job运行在独立的asyncio.Task里、上下文互不影响
+trace_id_var = ContextVar('trace_id', default=None)
+
 
 class Host:
     """
@@ -172,3 +177,27 @@ def get_trace_id_from_stack():
         f_back = f_back.f_back
         idx += 1
     return trace_id
+
+
+def get_trace_id():
+    """
+    获取当前上下文的trace_id
+    未设置时(非lock装饰器调起的代码)通过调用栈追溯
+    """
+    trace_id = trace_id_var.get()
+    if trace_id is None:
+        trace_id = get_trace_id_from_stack()
+    return trace_id
+
+
+def context_wrapper(func, *args, **kwargs):
+    """
+    复制当前上下文(trace_id等)、用于提交到线程池执行
+    >>> await loop.run_in_executor(executor, context_wrapper(time.sleep, 1))
+    """
+    ctx = copy_context()
+
+    def wrapper():
+        return ctx.run(func, *args, **kwargs)
+
+    return wrapper
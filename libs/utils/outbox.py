@@ -0,0 +1,87 @@
+"""
+本地持久化报警队列(SQLite)
+报警先写入本地文件、由后台协程聚合发送、发送成功之后删除
+程序重启之后未发送的报警会继续发送
+"""
+import os
+import time
+import hashlib
+import sqlite3
+
+
+class AlertOutbox:
+    """
+    >>> outbox = AlertOutbox('/data/logs/app/alert_outbox.db')
+    >>> outbox.put('执行任务tk异常: xxx', task_key='tk', err_type='ValueError')
+    >>> max_id, items = outbox.pending()
+    >>> outbox.ack(max_id)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            # WAL + NORMAL: 单次写入不需要等待fsync、进程崩溃不丢数据
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS alert_outbox ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'fingerprint TEXT NOT NULL, '
+                         'msg TEXT NOT NULL, '
+                         'created_at REAL NOT NULL)')
+            self.conn = conn
+        return self.conn
+
+    @staticmethod
+    def fingerprint(msg, task_key=None, err_type=None):
+        """
+        按 task_key + 错误类型去重、未指定时按消息内容去重
+        """
+        if task_key or err_type:
+            return '{}|{}'.format(task_key or '', err_type or '')
+        return 'msg|' + hashlib.md5(msg.encode('utf-8')).hexdigest()
+
+    def put(self, msg, task_key=None, err_type=None):
+        self.connect().execute('INSERT INTO alert_outbox (fingerprint, msg, created_at) VALUES (?, ?, ?)',
+                               (self.fingerprint(msg, task_key, err_type), msg, time.time()))
+
+    def pending(self):
+        """
+        按指纹聚合未发送的报警
+        返回 (max_id, items)、items 按首次出现顺序排列、msg 为最近一次的内容
+        """
+        conn = self.connect()
+        max_id, = conn.execute('SELECT MAX(id) FROM alert_outbox').fetchone()
+        if max_id is None:
+            return None, []
+        rows = conn.execute('SELECT o.msg, g.cnt, g.first_at, g.last_at FROM ('
+                            'SELECT COUNT(*) AS cnt, MIN(id) AS first_id, MAX(id) AS last_id, '
+                            'MIN(created_at) AS first_at, MAX(created_at) AS last_at FROM alert_outbox '
+                            'WHERE id <= ? GROUP BY fingerprint) g '
+                            'JOIN alert_outbox o ON o.id = g.last_id ORDER BY g.first_id', (max_id, )).fetchall()
+        items = [{'msg': msg, 'count': count, 'first_at': first_at, 'last_at': last_at}
+                 for msg, count, first_at, last_at in rows]
+        return max_id, items
+
+    def ack(self, max_id):
+        self.connect().execute('DELETE FROM alert_outbox WHERE id <= ?', (max_id, ))
+
+    def expire(self, max_age):
+        """
+        删除超过 max_age(s) 仍未发送成功的报警
+        """
+        cursor = self.connect().execute('DELETE FROM alert_outbox WHERE created_at < ?', (time.time() - max_age, ))
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM alert_outbox').fetchone()[0]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,99 @@
+"""
+进程内共享线程池
+同步任务方法(executor = thread)共用、并统计线程池饱和度
+AsyncModuleWrapper 使用各自独立的线程池、不受长时间阻塞的任务影响
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MeteredThreadPool(ThreadPoolExecutor):
+    """
+    带统计的线程池
+    >>> pool = MeteredThreadPool(max_workers=8, thread_name_prefix='assassin-sync')
+    >>> await loop.run_in_executor(pool, time.sleep, 1)
+    >>> pool.stats()
+    {'workers': 8, 'active': 0, 'queued': 0, 'submitted': 1, 'completed': 1, 'max_active': 1, ...}
+    """
+    def __init__(self, max_workers=None, thread_name_prefix=''):
+        super(MeteredThreadPool, self).__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._stats_lock = threading.Lock()
+        self.counters = {
+            'submitted': 0,
+            'completed': 0,
+            'active': 0,
+            'max_active': 0,
+            'max_queued': 0,
+            'saturated': 0,
+            'total_wait_ms': 0,
+            'max_wait_ms': 0,
+        }
+
+    def submit(self, fn, *args, **kwargs):
+        submit_at = time.perf_counter()
+
+        def run():
+            wait_ms = (time.perf_counter() - submit_at) * 1000
+            with self._stats_lock:
+                self.counters['active'] += 1
+                self.counters['max_active'] = max(self.counters['max_active'], self.counters['active'])
+                self.counters['total_wait_ms'] += wait_ms
+                self.counters['max_wait_ms'] = max(self.counters['max_wait_ms'], wait_ms)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.counters['active'] -= 1
+                    self.counters['completed'] += 1
+
+        with self._stats_lock:
+            self.counters['submitted'] += 1
+            queued = self.counters['submitted'] - self.counters['completed'] - self.counters['active']
+            self.counters['max_queued'] = max(self.counters['max_queued'], queued)
+            # 提交时所有线程都在忙、需要排队
+            if self.counters['active'] >= self._max_workers:
+                self.counters['saturated'] += 1
+        return super(MeteredThreadPool, self).submit(run)
+
+    def stats(self):
+        with self._stats_lock:
+            rst = dict(self.counters)
+        rst['workers'] = self._max_workers
+        rst['queued'] = rst['submitted'] - rst['completed'] - rst['active']
+        started = rst['completed'] + rst['active']
+        rst['avg_wait_ms'] = rst['total_wait_ms'] / started if started else 0
+        return rst
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_thread_pool():
+    """
+    进程内共享的线程池、大小为 common.toml [executor].thread_workers
+    """
+    with _shared_lock:
+        pool = _shared.get('pool')
+        if pool is None:
+            from libs.tomlread import ConfEntity
+            conf = ConfEntity().common.get('executor', {})
+            pool = _shared['pool'] = MeteredThreadPool(max_workers=conf.get('thread_workers', 8),
+                                                       thread_name_prefix='assassin-sync')
+        return pool
+
+
+def shared_pool_stats():
+    """
+    共享线程池使用情况、线程池还没有创建时返回None(不创建线程池)
+    """
+    pool = _shared.get('pool')
+    return pool.stats() if pool is not None else None
+
+
+def shutdown_shared_pool(wait=False):
+    with _shared_lock:
+        pool = _shared.pop('pool', None)
+    if pool is not None:
+        pool.shutdown(wait=wait)
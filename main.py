@@ -5,19 +5,29 @@ sys.path.append(project_path)
 sys.path.append(os.path.join(project_path, 'libs'))
 
 import signal
+import logging
 import traceback
 import asyncio
+from datetime import datetime, timedelta
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 
-from tasks import *
 from models.task import Task
-from libs.aps import lock, TriggerOperate, monitor_tasks, reset_tasks_status
+from libs.aps import TriggerOperate, monitor_tasks, reset_tasks_status, subscribe_task_changed, \
+    archive_execute_tasks
+from libs.tomlread import ConfEntity
 from libs.utils.other import Environ
-from libs.utils.notice import ding_ding_notice
+from libs.utils.notice import alert_dispatcher, check_ding_conf
 from libs.logger import LoggerPool
+from libs.aps.executors import ScheduledTimeAsyncIOExecutor, report_pool_stats, shutdown_executors
+from libs.aps.cluster import cluster
+from libs.aps.leader import elector, leader_only
+from libs.requests.session import close_sessions
+from libs.metrics import Counter
+from libs.metrics.server import start_metrics_server
+from web.runner import ApiRunner
 
 logger = LoggerPool.apscheduler
 loop = asyncio.get_event_loop()
@@ -31,13 +41,30 @@ job_defaults = {
     'misfire_grace_time': 60
 }
 
-# scheduler实例
-scheduler = AsyncIOScheduler(job_defaults=job_defaults)
+# scheduler实例(executor 把计划执行时间写入上下文、用于统计调度延迟)
+scheduler = AsyncIOScheduler(job_defaults=job_defaults, executors={'default': ScheduledTimeAsyncIOExecutor()})
+# 根据任务配置构建job(execute_func 从 tasks 模块解析)
+trigger_operate = TriggerOperate(scheduler)
 tasks_mapper = {
     # 'task.id_task.task_key': {
     #      'spec': task.spec
     # }
 }
+# 同步配置
+sync_conf = ConfEntity().common.get('sync', {})
+# 接口服务(多进程)
+api_conf = ConfEntity().common.get('api', {})
+api_runner = ApiRunner(os.path.join(project_path, 'web.py'), port=api_conf.get('port', 8888),
+                       workers=api_conf.get('workers', 0), max_restarts=api_conf.get('max_restarts', 100))
+# 增量同步水位(task.update_at最大值)
+# 任务只保存在内存jobstore、进程重启之后需要全量同步、所以水位只在进程内维护
+# ring_version: 集群节点变化之后需要全量同步、重新分配任务
+sync_state = {
+    'watermark': None,
+    'cycles': 0,
+    'ring_version': 0
+}
+job_events = Counter('assassin_job_events_total', 'apscheduler异常事件', ['event'])
 
 
 def err_listener(ev):
@@ -47,60 +74,110 @@ def err_listener(ev):
     msg = ''
     if ev.code == EVENT_JOB_ERROR:
         msg = ev.traceback
+        job_events.inc('error')
     elif ev.code == EVENT_JOB_MISSED:
         msg = 'missed job, job_id: %s, schedule_run_time: %s' % (ev.job_id, ev.scheduled_run_time)
+        job_events.inc('missed')
     elif ev.code == EVENT_JOB_MAX_INSTANCES:
         msg = 'reached maximum of running instances, job_id: %s' % ev.job_id
+        job_events.inc('max_instances')
     logger.error({'panic_keyword': 'program_error', 'err': msg, 'err_type': ev.code})
 
 
-async def sync_schedule_task():
+async def apply_task(t):
     """
-    同步数据库定时任务到 apschedule
+    将单条任务同步到 apschedule
     """
-    for t in Task.select():
-        tid = '{}_{}'.format(t.id, t.task_key)
-        job = scheduler.get_job(tid)
-        # 移除任务
-        if t.is_valid == 0:
-            tasks_mapper.pop(tid, None)
-            if not job:
-                continue
-            try:
-                scheduler.remove_job(tid)
-                logger.info({'keyword': 'remove_job', 'job_id': tid})
-            except Exception as e:
-                logger.error({'panic_keyword': 'remove_job_err', 'err': traceback.format_exc()})
-                await ding_ding_notice('移除任务{}异常: {}'.format(tid, e))
-            continue
-        task_conf = tasks_mapper.get(tid, {})
-        # 任务已存在 - 检查调度时间是否改变
-        if job:
-            # 调度方式未改变
-            if task_conf.get('spec') == t.spec:
-                continue
-            evl_task = TriggerOperate.modify_trigger(t.trigger, t.spec, tid)
-            try:
-                exec(evl_task)
-            except Exception as e:
-                logger.error({'panic_keyword': 'reschedule_job_err', 'err': traceback.format_exc()})
-                await ding_ding_notice('更新任务{}异常: {}'.format(tid, e))
-            tasks_mapper[tid] = {
-                'spec': t.spec
-            }
-            logger.info({'keyword': 'modify_job', 'job_id': tid})
-            continue
-        # 新创建任务
-        evl_task = TriggerOperate().add_trigger(t.trigger, t.spec, tid, t.execute_func, t.task_key, t.args)
+    tid = '{}_{}'.format(t.id, t.task_key)
+    job = scheduler.get_job(tid)
+    # 移除任务(集群模式下不属于当前节点的任务同样移除)
+    if t.is_valid == 0 or not cluster.owns(t.task_key):
+        tasks_mapper.pop(tid, None)
+        if not job:
+            return
         try:
-            eval(evl_task)
+            scheduler.remove_job(tid)
+            logger.info({'keyword': 'remove_job', 'job_id': tid})
         except Exception as e:
-            logger.error({'panic_keyword': 'sync_schedule_task_err', 'err': traceback.format_exc()})
-            await ding_ding_notice('新增任务{}异常: {}'.format(tid, e))
+            logger.error({'panic_keyword': 'remove_job_err', 'err': traceback.format_exc()})
+            alert_dispatcher.notify('移除任务{}异常: {}'.format(tid, e), task_key=tid, err_type='remove_job')
+        return
+    task_conf = tasks_mapper.get(tid, {})
+    executor = trigger_operate.get_executor(t.extra)
+    # 任务已存在 - 检查调度时间及执行方式是否改变
+    if job:
+        # 调度方式及执行方式未改变
+        if task_conf.get('spec') == t.spec and task_conf.get('executor', 'loop') == executor:
+            return
+        try:
+            if task_conf.get('spec') != t.spec:
+                trigger_operate.reschedule_job(tid, t.trigger, t.spec)
+            if task_conf.get('executor', 'loop') != executor:
+                trigger_operate.modify_executor(tid, t.execute_func, executor)
+        except Exception as e:
+            logger.error({'panic_keyword': 'reschedule_job_err', 'err': traceback.format_exc()})
+            alert_dispatcher.notify('更新任务{}异常: {}'.format(tid, e), task_key=tid, err_type='reschedule_job')
         tasks_mapper[tid] = {
-            'spec': t.spec
+            'spec': t.spec,
+            'executor': executor,
         }
-        logger.info({'keyword': 'add_job', 'job_id': tid})
+        logger.info({'keyword': 'modify_job', 'job_id': tid, 'executor': executor})
+        return
+    # 新创建任务
+    try:
+        trigger_operate.add_job(tid, t.trigger, t.spec, t.execute_func, t.task_key, t.args, executor)
+    except Exception as e:
+        logger.error({'panic_keyword': 'sync_schedule_task_err', 'err': traceback.format_exc()})
+        alert_dispatcher.notify('新增任务{}异常: {}'.format(tid, e), task_key=tid, err_type='add_job')
+    tasks_mapper[tid] = {
+        'spec': t.spec,
+        'executor': executor,
+    }
+    logger.info({'keyword': 'add_job', 'job_id': tid})
+
+
+async def sync_schedule_task():
+    """
+    同步数据库定时任务到 apschedule
+    incremental模式下只拉取 update_at 超过水位的任务、每 full_sync_cycles 个周期做一次全量校准
+    """
+    query = Task.select()
+    full_sync = sync_conf.get('mode', 'full') != 'incremental' or sync_state['watermark'] is None or \
+        sync_state['cycles'] % sync_conf.get('full_sync_cycles', 60) == 0 or \
+        sync_state['ring_version'] != cluster.version
+    if not full_sync:
+        # update_at 精度为秒、回看一个窗口防止同一秒内后提交的数据被漏掉
+        since = sync_state['watermark'] - timedelta(seconds=sync_conf.get('overlap', 5))
+        query = query.where(Task.update_at >= since)
+    sync_state['cycles'] += 1
+    sync_state['ring_version'] = cluster.version
+    watermark = sync_state['watermark']
+    for t in query:
+        if watermark is None or t.update_at > watermark:
+            watermark = t.update_at
+        await apply_task(t)
+    sync_state['watermark'] = watermark
+    if full_sync:
+        logger.info({'keyword': 'full_sync_task', 'watermark': watermark, 'ring_version': cluster.version})
+
+
+async def cluster_heartbeat():
+    """
+    集群节点心跳、节点变化之后立即全量同步重新分配任务
+    """
+    if await cluster.heartbeat():
+        await sync_schedule_task()
+
+
+async def on_task_changed(task_id):
+    """
+    收到任务变更推送之后立即同步该任务
+    """
+    t = Task.get_or_none(Task.id == task_id)
+    if t is None:
+        return
+    await apply_task(t)
+    logger.info({'keyword': 'push_sync_task', 'task_id': task_id})
 
 
 async def shutdown():
@@ -109,8 +186,22 @@ async def shutdown():
     # 等待timeout之后重置doing状态的任务
     logger.info('开始重置任务状态')
     await reset_tasks_status()
+    # 尝试发送本地队列中剩余的报警、未成功的在下次启动之后继续发送
+    await alert_dispatcher.close()
+    # 退出集群、其他节点接管当前节点的任务
+    await cluster.leave()
+    # 让出leader、其他节点立即接管
+    await elector.resign()
+    # 关闭任务线程池/进程池
+    shutdown_executors()
+    # 关闭共享的http连接池
+    await close_sessions()
+    # 确保接口服务进程组已经退出
+    api_runner.kill()
     # 等待timeout秒之后退出主程序（确保scheduler中的程序全部执行完毕）
     logger.info('程序退出')
+    # os._exit 不会执行 atexit、手动刷新日志队列
+    logging.shutdown()
     os._exit(0)
 
 
@@ -121,6 +212,8 @@ def signal_handler(signalnum, frame):
     logger.info('dawn cron-task receive term signal')
     # 设置环境变量
     Environ().IS_KILLED = 'KILLED'
+    # 关闭接口服务
+    api_runner.terminate()
     # 等待所有任务执行完成之后再退出（优雅关闭）
     scheduler.add_job(shutdown)
 
@@ -128,13 +221,45 @@ def signal_handler(signalnum, frame):
 if __name__ == '__main__':
     # to catch term signal
     signal.signal(signal.SIGTERM, signal_handler)
-    # to run web api background
-    os.system('python {} &'.format(os.path.join(project_path, 'web.py')))
+    # to run web api background (multi-process, supervised)
+    if api_conf.get('enabled', True):
+        api_runner.start()
+        scheduler.add_job(api_runner.supervise, 'interval', seconds=api_conf.get('supervise_interval', 10),
+                          id='api_supervisor')
     # run scheduler main process
     scheduler.add_listener(err_listener, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
     # scheduler.add_job(sync_schedule_task, trigger=CronTrigger.from_crontab('* * * * *'), id='sync_task')
     scheduler.add_job(sync_schedule_task, 'interval', seconds=10, id='sync_task_all')
-    scheduler.add_job(monitor_tasks, trigger=CronTrigger.from_crontab('*/10 * * * *'))
+    if cluster.enabled:
+        # 启动时立即执行一次心跳、在第一次同步任务之前获取集群节点
+        cluster_conf = ConfEntity().common.get('cluster', {})
+        scheduler.add_job(cluster_heartbeat, 'interval', seconds=cluster_conf.get('heartbeat_interval', 10),
+                          id='cluster_heartbeat', next_run_time=datetime.now())
+    # leader选举、监控/归档只在leader节点执行
+    leader_conf = ConfEntity().common.get('leader', {})
+    scheduler.add_job(elector.campaign, 'interval', seconds=leader_conf.get('interval', 5), id='leader_campaign',
+                      next_run_time=datetime.now())
+    scheduler.add_job(leader_only(monitor_tasks), trigger=CronTrigger.from_crontab('*/10 * * * *'))
+    retention_cron = ConfEntity().common.get('retention', {}).get('cron', '30 3 * * *')
+    scheduler.add_job(leader_only(archive_execute_tasks), trigger=CronTrigger.from_crontab(retention_cron))
+    executor_conf = ConfEntity().common.get('executor', {})
+    scheduler.add_job(report_pool_stats, 'interval', seconds=executor_conf.get('stats_interval', 60),
+                      id='pool_stats')
+    # 订阅任务变更推送、秒级生效
+    loop.create_task(subscribe_task_changed(on_task_changed))
+    # 缺少钉钉配置时报警直接丢弃、启动时提示一次
+    check_ding_conf()
+    # 发送上次退出前未成功的报警
+    alert_dispatcher.ensure_running()
+    # 指标端口(Prometheus)
+    metrics_conf = ConfEntity().common.get('metrics', {})
+    if metrics_conf.get('enabled', True):
+        try:
+            loop.run_until_complete(start_metrics_server(metrics_conf.get('host', '0.0.0.0'),
+                                                         metrics_conf.get('port', 9108)))
+        except OSError:
+            # 端口被占用不影响调度
+            logger.error({'panic_keyword': 'metrics_server_err', 'err': traceback.format_exc()})
 
     scheduler.start()
 
@@ -0,0 +1,3 @@
+-- redis锁(common.toml [lock].backend = "redis")抢占时的fencing token
+ALTER TABLE `execute_task`
+    ADD COLUMN `fence_token` bigint(20) NOT NULL DEFAULT 0 COMMENT 'redis锁fencing token' AFTER `trace_id`;
@@ -0,0 +1,4 @@
+-- monitor_tasks 按 task_id 分组取最近一次执行纪录、子任务列表按 task_id 查询
+ALTER TABLE `execute_task`
+    ADD INDEX `ix__execute_task__task_id_id`(`task_id`, `id`) USING BTREE COMMENT 'task_id/id联合索引',
+    ALGORITHM = INPLACE, LOCK = NONE;
@@ -0,0 +1,3 @@
+-- 子任务执行耗时
+ALTER TABLE `execute_task`
+    ADD COLUMN `duration_ms` int(11) NULL DEFAULT NULL COMMENT '执行耗时(ms)' AFTER `fence_token`;
@@ -0,0 +1,9 @@
+-- 子任务执行时间线(精确到ms)及调度延迟、按时间窗口统计执行耗时分位数
+-- /assassin/task_stats 使用窗口函数 CUME_DIST 计算分位数、需要 MySQL 8.0+(5.7 返回 501)
+ALTER TABLE `execute_task`
+    ADD COLUMN `scheduled_at` datetime(3) NULL DEFAULT NULL COMMENT '计划执行时间' AFTER `duration_ms`,
+    ADD COLUMN `lock_at` datetime(3) NULL DEFAULT NULL COMMENT '获取锁时间' AFTER `scheduled_at`,
+    ADD COLUMN `start_at` datetime(3) NULL DEFAULT NULL COMMENT '开始执行时间' AFTER `lock_at`,
+    ADD COLUMN `end_at` datetime(3) NULL DEFAULT NULL COMMENT '执行结束时间' AFTER `start_at`,
+    ADD COLUMN `lateness_ms` int(11) NULL DEFAULT NULL COMMENT '调度延迟(ms)' AFTER `end_at`,
+    ADD INDEX `ix__execute_task__start_at`(`start_at`) USING BTREE COMMENT '按时间窗口统计';
@@ -0,0 +1,4 @@
+-- 归档按 create_at 查找过期数据的id上界
+ALTER TABLE `execute_task`
+    ADD INDEX `ix__execute_task__create_at`(`create_at`) USING BTREE COMMENT '按创建时间归档',
+    ALGORITHM = INPLACE, LOCK = NONE;
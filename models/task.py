@@ -1,13 +1,27 @@
 """
 任务相关model
 """
+import traceback
 from copy import deepcopy
 
 import peewee
+from peewee import fn, Case
 
 from libs.mysql import MysqlPools
+from libs.logger import LoggerPool
 from . import JsonField
 
+logger = LoggerPool.other
+# MySQL 5.7 不支持窗口函数: 1064 语法错误 / 1305 函数不存在
+WINDOW_FUNCTION_ERRORS = (1064, 1305)
+
+
+class WindowFunctionUnavailable(Exception):
+    """
+    数据库不支持窗口函数(需要 MySQL 8.0+)
+    """
+    pass
+
 
 class Task(peewee.Model):
     """
@@ -32,6 +46,9 @@ class Task(peewee.Model):
     create_at = peewee.DateTimeField()
     update_at = peewee.DateTimeField()
 
+    # 异步操作(peewee_async.Manager)
+    async_objects = MysqlPools.default.manager
+
     class Meta:
         database = MysqlPools.default.db_conn
         # MysqlPools之所有有default属性、是在mysql.toml里配置的
@@ -73,6 +90,113 @@ class Task(peewee.Model):
                 trans.rollback()
         return is_success, err
 
+    @classmethod
+    async def async_task_atomic_insert(cls, task_key, trace_id):
+        """
+        task_atomic_insert 的异步版本、不阻塞事件循环
+        只有任务不是ready状态(已被锁定)时返回未抢到锁、数据库异常直接抛出
+        """
+        objects = cls.async_objects
+        execute_success = False
+        sub_task_id = None
+        try:
+            async with objects.atomic():
+                task = await objects.get(cls.select().where(cls.task_key == task_key, cls.status == 'ready',
+                                                            cls.is_valid == 1).for_update())
+                await objects.execute(cls.update(status='doing').where(cls.task_key == task_key))
+                sub = await objects.create(TaskExecute, task_id=task.id, status='todo', extra={}, trace_id=trace_id)
+                sub_task_id = sub.id
+            execute_success = True
+        except cls.DoesNotExist:
+            # 任务已被其他节点锁定(status=doing)或已失效
+            pass
+        except Exception:
+            logger.error({'panic_keyword': 'task_atomic_insert_err', 'err': traceback.format_exc(),
+                          'task_key': task_key})
+            raise
+        return execute_success, sub_task_id
+
+    @classmethod
+    async def async_task_atomic_update(cls, task_key, sub_task_id, status, _ext, **fields):
+        """
+        task_atomic_update 的异步版本、不阻塞事件循环
+        :param fields: 子任务其他字段(duration_ms等)
+        """
+        objects = cls.async_objects
+        is_success, err = True, None
+        try:
+            async with objects.atomic():
+                await objects.execute(cls.update(status='ready').where(cls.task_key == task_key))
+                sub = await objects.get(TaskExecute.select().where(TaskExecute.id == sub_task_id))
+                ext = deepcopy(sub.extra)
+                ext.update(**_ext)
+                await objects.execute(TaskExecute.update(extra=ext, status=status, **fields).
+                                      where(TaskExecute.id == sub_task_id))
+        except Exception as e:
+            is_success, err = False, e
+        return is_success, err
+
+    @classmethod
+    async def async_task_fenced_insert(cls, task_key, trace_id, fence_token):
+        """
+        redis锁抢占成功之后写入子任务(不再加行锁)
+        """
+        objects = cls.async_objects
+        task = await objects.get(cls.select(cls.id).where(cls.task_key == task_key, cls.is_valid == 1))
+        async with objects.atomic():
+            await objects.execute(cls.update(status='doing').where(cls.id == task.id))
+            sub = await objects.create(TaskExecute, task_id=task.id, status='todo', extra={}, trace_id=trace_id,
+                                       fence_token=fence_token)
+        return task.id, sub.id
+
+    @classmethod
+    def fenced_ready_query(cls, task_id, fence_token):
+        """
+        重置父任务状态；已有更大fencing token的执行纪录时不再修改(租约已过期被其他节点抢占)
+        """
+        newer = TaskExecute.select(TaskExecute.id).where(TaskExecute.task_id == task_id,
+                                                         TaskExecute.fence_token > fence_token)
+        return cls.update(status='ready').where(cls.id == task_id, ~fn.EXISTS(newer))
+
+    @classmethod
+    async def async_task_fenced_update(cls, task_id, sub_task_id, status, _ext, fence_token, **fields):
+        """
+        redis锁执行完成之后更新父任务和子任务状态
+        """
+        objects = cls.async_objects
+        is_success, err = True, None
+        try:
+            async with objects.atomic():
+                await objects.execute(cls.fenced_ready_query(task_id, fence_token))
+                sub = await objects.get(TaskExecute.select().where(TaskExecute.id == sub_task_id))
+                ext = deepcopy(sub.extra)
+                ext.update(**_ext)
+                await objects.execute(TaskExecute.update(extra=ext, status=status, **fields).
+                                      where(TaskExecute.id == sub_task_id))
+        except Exception as e:
+            is_success, err = False, e
+        return is_success, err
+
+    @classmethod
+    async def async_task_ready(cls, task_key=None, task_id=None, fence_token=None):
+        """
+        只重置父任务状态(子任务状态由 ExecuteWriter 批量写入)
+        """
+        if fence_token is not None:
+            query = cls.fenced_ready_query(task_id, fence_token)
+        else:
+            query = cls.update(status='ready').where(cls.task_key == task_key)
+        return await cls.async_objects.execute(query)
+
+    @classmethod
+    async def async_bulk_update_extra(cls, exts):
+        """
+        批量更新extra、单条 UPDATE ... SET extra = CASE id WHEN ... END
+        :param exts: {task_id: extra}
+        """
+        case = Case(cls.id, [(pk, cls.extra.to_value(ext)) for pk, ext in exts.items()])
+        return await cls.async_objects.execute(cls.update(extra=case).where(cls.id.in_(list(exts))))
+
     def update_ext(self, tk=None, **kwargs):
         if self.id is None and tk is None:
             raise Exception('Can not update empty instance')
@@ -94,12 +218,88 @@ class TaskExecute(peewee.Model):
     status = peewee.CharField(help_text='执行状态')
     extra = JsonField(help_text='额外信息(json格式)', default={})
     trace_id = peewee.CharField(help_text='trace_id')
+    fence_token = peewee.BigIntegerField(help_text='redis锁fencing token', default=0)
+    duration_ms = peewee.IntegerField(help_text='执行耗时(ms)', null=True)
+    # 执行时间线(精确到ms、migrations/004)
+    scheduled_at = peewee.DateTimeField(help_text='计划执行时间', null=True)
+    lock_at = peewee.DateTimeField(help_text='获取锁时间', null=True)
+    start_at = peewee.DateTimeField(help_text='开始执行时间', null=True)
+    end_at = peewee.DateTimeField(help_text='执行结束时间', null=True)
+    lateness_ms = peewee.IntegerField(help_text='调度延迟(ms): start_at - scheduled_at', null=True)
     create_at = peewee.DateTimeField()
     update_at = peewee.DateTimeField()
 
+    # 异步操作(peewee_async.Manager)
+    async_objects = MysqlPools.default.manager
+
     class Meta:
         database = MysqlPools.default.db_conn
         db_table = 'execute_task'
+        indexes = (
+            # 按任务查询最近执行纪录(migrations/002)
+            (('task_id', 'id'), False),
+            # 按时间窗口统计执行耗时(migrations/004)
+            (('start_at', ), False),
+            # 归档按创建时间查找过期数据(migrations/005)
+            (('create_at', ), False),
+        )
+
+    @classmethod
+    async def async_percentile_stats(cls, since, task_id=None, percentiles=(50, 95, 99)):
+        """
+        按任务统计时间窗口内执行耗时/调度延迟的分位数(最近秩法)
+        分位数在数据库中通过窗口函数 CUME_DIST 计算(MySQL 8.0+)、不加载明细数据
+        :return: [{'task_id': 1, 'runs': 10, 'duration_p50': 12, ..., 'lateness_p99': 30}]
+        """
+        where = [cls.start_at >= since, cls.duration_ms.is_null(False), cls.lateness_ms.is_null(False)]
+        if task_id is not None:
+            where.append(cls.task_id == task_id)
+        inner = cls.select(
+            cls.task_id, cls.duration_ms, cls.lateness_ms,
+            fn.CUME_DIST().over(partition_by=[cls.task_id], order_by=[cls.duration_ms]).alias('duration_rank'),
+            fn.CUME_DIST().over(partition_by=[cls.task_id], order_by=[cls.lateness_ms]).alias('lateness_rank'),
+        ).where(*where).alias('runs')
+        columns = [inner.c.task_id, fn.COUNT(inner.c.task_id).alias('runs'),
+                   fn.AVG(inner.c.duration_ms).alias('duration_avg'), fn.MAX(inner.c.duration_ms).alias('duration_max')]
+        for name in ('duration', 'lateness'):
+            value, rank = getattr(inner.c, name + '_ms'), getattr(inner.c, name + '_rank')
+            for p in percentiles:
+                # 第p分位数: 累计分布 >= p% 的最小值
+                columns.append(fn.MIN(Case(None, [(rank >= p / 100.0, value)])).alias('{}_p{}'.format(name, p)))
+        query = cls.select(*columns).from_(inner).group_by(inner.c.task_id).order_by(inner.c.task_id)
+        try:
+            return list(await cls.async_objects.execute(query.dicts()))
+        except Exception as e:
+            if e.args and e.args[0] in WINDOW_FUNCTION_ERRORS:
+                raise WindowFunctionUnavailable('percentile stats require MySQL 8.0+ (window functions): {}'.
+                                                format(e)) from e
+            raise
+
+    @classmethod
+    async def async_bulk_update(cls, rows):
+        """
+        批量更新子任务: 一次查询读取extra合并、一条 UPDATE ... CASE id 写回
+        :param rows: {sub_task_id: {'fields': {column: value}, 'extra': {...}}}
+        """
+        objects = cls.async_objects
+        ids = list(rows)
+        async with objects.atomic():
+            olds = await objects.execute(cls.select(cls.id, cls.extra).where(cls.id.in_(ids)).for_update())
+            exts = []
+            for old in olds:
+                ext = deepcopy(old.extra) if isinstance(old.extra, dict) else {}
+                ext.update(**rows[old.id]['extra'])
+                exts.append((old.id, cls.extra.to_value(ext)))
+            if not exts:
+                return 0
+            values = {cls.extra: Case(cls.id, exts)}
+            columns = {column for row in rows.values() for column in row['fields']}
+            for column in columns:
+                field = cls._meta.fields[column]
+                whens = [(pk, field.to_value(row['fields'][column])) for pk, row in rows.items()
+                         if column in row['fields']]
+                values[field] = Case(cls.id, whens, field)
+            return await objects.execute(cls.update(values).where(cls.id.in_(ids)))
 
     def update_ext(self, pk=None, **kwargs):
         if self.id is None and pk is None:
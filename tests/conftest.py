@@ -0,0 +1,26 @@
+"""
+测试环境与离线压测一致(APP_ENV=bench): MySQL/Redis/钉钉 使用 benchmarks/standins.py 中的本地替身
+依赖见 benchmarks/requirements.txt
+
+pip install -r benchmarks/requirements.txt pytest
+python -m pytest -q tests
+"""
+import os
+import sys
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_path)
+sys.path.append(os.path.join(project_path, 'libs'))
+
+# 配置文件按相对路径读取、必须在导入项目模块之前设置
+os.chdir(project_path)
+os.environ.setdefault('APP_ENV', 'bench')
+os.makedirs('/tmp/assassin-bench/logs', exist_ok=True)
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
@@ -0,0 +1,29 @@
+import asyncio
+
+from libs.requests.cache import ResponseCache
+
+
+def test_waiters_survive_leader_cancel(loop):
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'status': 200, 'url': 'http://www.test.com/api', 'body': str(len(calls))}
+
+    async def run():
+        cache = ResponseCache()
+        leader = asyncio.ensure_future(cache.get_or_fetch('get:http://www.test.com/api', 30, loader))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(cache.get_or_fetch('get:http://www.test.com/api', 30, loader))
+                   for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        items = await asyncio.gather(*waiters)
+        return leader, items
+
+    leader, items = loop.run_until_complete(run())
+    assert leader.cancelled()
+    # 其中一个等待者重新发起请求、其他等待者共享结果
+    assert [item['body'] for item in items] == ['2', '2']
+    assert len(calls) == 2
@@ -0,0 +1,54 @@
+import importlib.util
+import os
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+import main as app
+from models.task import Task
+from web.api import task as task_api
+from benchmarks import standins
+
+
+def load_application():
+    """
+    web.py 与 web 包同名、按文件路径加载
+    """
+    spec = importlib.util.spec_from_file_location('assassin_web', os.path.join(app.project_path, 'web.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Application()
+
+
+def test_put_moves_sync_watermark(loop, tmp_path):
+    task_api.objects = standins.bind_sqlite(str(tmp_path / 'task.db'))
+    loop.run_until_complete(standins.use_fakeredis())
+    standins.seed_tasks(1)
+    app.scheduler.remove_all_jobs()
+    app.tasks_mapper.clear()
+    app.sync_state.update(watermark=None, cycles=0)
+    # 第一次为全量同步、之后按水位增量同步
+    loop.run_until_complete(app.sync_schedule_task())
+    watermark = app.sync_state['watermark']
+    task = Task.get()
+    tid = '{}_{}'.format(task.id, task.task_key)
+    assert app.tasks_mapper[tid]['spec'] != '*/10 * * * *'
+
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(load_application())
+    server.add_sockets(sockets)
+    body = urlencode({'task_id': task.id, 'desc': task.desc, 'status': task.status, 'trigger': 'cron',
+                      'spec': '*/10 * * * *', 'args': task.args, 'is_valid': 1, 'extra': '{}'})
+    try:
+        rsp = loop.run_until_complete(AsyncHTTPClient().fetch(
+            'http://127.0.0.1:{}/assassin/task'.format(sockets[0].getsockname()[1]), method='PUT', body=body))
+    finally:
+        server.stop()
+    assert rsp.code == 200
+
+    # 不依赖变更推送、增量同步即可拉取到修改
+    loop.run_until_complete(app.sync_schedule_task())
+    assert app.sync_state['watermark'] > watermark
+    assert app.tasks_mapper[tid]['spec'] == '*/10 * * * *'
@@ -7,13 +7,18 @@ sys.path.append(os.path.join(project_path, 'libs'))
 import tornado.web
 import tornado.locks
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
+from tornado.httpserver import HTTPServer
 from tornado.options import define, options
 from tornado_swagger.setup import setup_swagger
 
-from web.api.task import TaskHandler, TasksHandler, SubTasksHandler
+from web.api.task import TaskHandler, TasksHandler, SubTasksHandler, TaskStatsHandler
 from web.middlewares import get_middleware
 
 define("port", default=8888, help="run on the given port", type=int)
+define("workers", default=1, help="number of worker processes, 0 means one per cpu", type=int)
+define("max_restarts", default=100, help="max times to restart dead worker processes", type=int)
 
 
 class Application(tornado.web.Application):
@@ -23,19 +28,30 @@ class Application(tornado.web.Application):
         handlers = [
             tornado.web.url('/assassin/tasks', TasksHandler, {'middleware': middleware_tuple}),
             tornado.web.url('/assassin/task', TaskHandler, {'middleware': middleware_tuple}),
-            tornado.web.url('/assassin/sub_tasks', SubTasksHandler, {'middleware': middleware_tuple})
+            tornado.web.url('/assassin/sub_tasks', SubTasksHandler, {'middleware': middleware_tuple}),
+            tornado.web.url('/assassin/task_stats', TaskStatsHandler, {'middleware': middleware_tuple})
         ]
         setup_swagger(handlers, description='Assassin API Definition', title='Assassin API')
         super(Application, self).__init__(handlers)
 
 
-async def main_web():
-    tornado.options.parse_command_line()
+async def main_web(sockets):
     app = Application()
-    app.listen(options.port)
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
     shutdown_event = tornado.locks.Event()
     await shutdown_event.wait()
 
 
+def main():
+    tornado.options.parse_command_line()
+    # 先绑定端口再fork、所有worker共享同一个监听socket
+    sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+    if options.workers != 1:
+        # 主进程负责监控worker、worker异常退出之后自动重启
+        tornado.process.fork_processes(options.workers, max_restarts=options.max_restarts)
+    tornado.ioloop.IOLoop.current().run_sync(lambda: main_web(sockets))
+
+
 if __name__ == '__main__':
-    tornado.ioloop.IOLoop.current().run_sync(main_web)
+    main()
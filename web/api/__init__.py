@@ -1,6 +1,10 @@
 from tornado.web import RequestHandler
 
-from web.errors import AssassinException
+from libs.tomlread import ConfEntity
+from web.errors import AssassinException, BadRequestException
+
+# 单页最多返回条数
+MAX_PAGE_SIZE = ConfEntity().common.get('api', {}).get('max_page_size', 100)
 
 
 class AssassinBaseHandler(RequestHandler):
@@ -12,6 +16,25 @@ class AssassinBaseHandler(RequestHandler):
         for mid in self.middleware:
             mid.process_request(self)
 
+    def get_page_arguments(self):
+        """
+        分页参数
+        page/size: 页码分页(兼容旧接口)、page >= 1、1 <= size <= MAX_PAGE_SIZE
+        after_id: 游标分页、返回id小于after_id的数据(按id倒序)
+        with_total: 是否返回总数
+        """
+        page = self.get_argument('page', '1')
+        size = self.get_argument('size', '20')
+        after_id = self.get_argument('after_id', '')
+        with_total = self.get_argument('with_total', '')
+        if not page.isdigit() or not size.isdigit():
+            raise BadRequestException('page and size should be int')
+        if int(page) < 1 or not 1 <= int(size) <= MAX_PAGE_SIZE:
+            raise BadRequestException('page should be >= 1 and size should be between 1 and {}'.format(MAX_PAGE_SIZE))
+        if after_id and not after_id.isdigit():
+            raise BadRequestException('after_id should be int')
+        return int(page), int(size), int(after_id) if after_id else None, with_total in ('1', 'true')
+
     def finish_success(self, data=None):
         base = {
             'code': 200,
@@ -1,11 +1,45 @@
 import json
+from datetime import datetime, timedelta
 from tornado_swagger.model import register_swagger_model
 
-from models.task import TaskExecute, Task
+from models.task import TaskExecute, Task, WindowFunctionUnavailable
 from libs.utils.datekit import datetime_fmt
-from web.errors import BadRequestException
+from libs.aps import publish_task_changed
+from libs.tomlread import ConfEntity
+from libs.utils.cache import TTLCache
+from web.errors import BadRequestException, NotImplementedException
 from . import AssassinBaseHandler
 
+api_conf = ConfEntity().common.get('api', {})
+# 列表总数缓存、深分页不必每次 count()
+total_cache = TTLCache(maxsize=1024, ttl=api_conf.get('total_cache_ttl', 30))
+# 数据库操作统一走 peewee_async、不阻塞 IOLoop
+objects = Task.async_objects
+
+
+async def cached_count(key, query):
+    cnt = total_cache.get(key)
+    if cnt is None:
+        cnt = await objects.count(query)
+        total_cache.set(key, cnt)
+    return cnt
+
+
+async def first(query):
+    rows = await objects.execute(query.limit(1))
+    for row in rows:
+        return row
+    return None
+
+
+def datetime_ms_fmt(dt):
+    """
+    执行时间线字段精确到ms
+    """
+    if dt is None:
+        return None
+    return datetime_fmt(dt, '%Y-%m-%d %H:%M:%S.%f')[:-3]
+
 
 class TasksHandler(AssassinBaseHandler):
     async def get(self, *args, **kwargs):
@@ -26,10 +60,22 @@ class TasksHandler(AssassinBaseHandler):
               default: 1
             - in: "query"
               name: size
-              description: 每页展示条数(默认20)
+              description: 每页展示条数(默认20、最大100)
               required: true
               type: integer
               default: 20
+            - in: "query"
+              name: after_id
+              description: 游标分页、返回id小于after_id的数据(传入之后忽略page)
+              required: false
+              type: integer
+            - in: "query"
+              name: with_total
+              description: 游标分页时是否返回总数(缓存)
+              required: false
+              type: integer
+              enum: [0, 1]
+              default: 0
         responses:
             200:
               description: list of tasks
@@ -38,21 +84,25 @@ class TasksHandler(AssassinBaseHandler):
             400:
               description: page and size should be int
         """
-        page = self.get_argument('page', '1')
-        size = self.get_argument('size', '20')
-        if not page.isdigit() or not size.isdigit():
-            raise BadRequestException('page and size should be int')
+        page, size, after_id, with_total = self.get_page_arguments()
         query = Task.select().order_by(-Task.id)
-        cnt = query.count()
-        tasks = query.paginate((int(page) - 1) * int(size), int(size)).dicts()
+        cnt = None
+        if after_id is not None:
+            tasks = await objects.execute(query.where(Task.id < after_id).limit(size).dicts())
+        else:
+            tasks = await objects.execute(query.paginate(page, size).dicts())
+        # 游标分页只在需要时返回总数
+        if after_id is None or with_total:
+            cnt = await cached_count(('tasks', ), query)
         tasks = list(tasks)
         for task in tasks:
             task['create_at'] = datetime_fmt(task['create_at'])
             task['update_at'] = datetime_fmt(task['update_at'])
         rst = {
-            'page': page,
-            'size': size,
+            'page': str(page),
+            'size': str(size),
             'total': cnt,
+            'next_after_id': tasks[-1]['id'] if tasks and len(tasks) == size else None,
             'data': tasks
         }
         return self.finish_success(rst)
@@ -83,10 +133,12 @@ class TaskHandler(AssassinBaseHandler):
               description: task_id is invalid
         """
         pk = self.get_argument('task_id', '')
-        query = Task.select().filter(Task.id == pk)
-        if not query.exists():
+        if not pk.isdigit():
             raise BadRequestException('task_id: `{}` is invalid'.format(pk))
-        task = query.dicts().get()
+        tasks = list(await objects.execute(Task.select().filter(Task.id == pk).dicts()))
+        if not tasks:
+            raise BadRequestException('task_id: `{}` is invalid'.format(pk))
+        task = tasks[0]
         task['create_at'] = datetime_fmt(task['create_at'])
         task['update_at'] = datetime_fmt(task['update_at'])
         return self.finish_success(task)
@@ -164,7 +216,7 @@ class TaskHandler(AssassinBaseHandler):
         if err is not None:
             raise BadRequestException('Trigger:`{}` and Spec:`{}` does not match'.format(trigger, spec))
         task_key = self.get_argument('task_key')
-        task = Task.select().filter(Task.task_key == task_key).first()
+        task = await first(Task.select().filter(Task.task_key == task_key))
         if task:
             raise BadRequestException('task_key: `{}` has existed, pls retry'.format(task_key))
         execute_func = self.get_argument('execute_func')
@@ -174,8 +226,10 @@ class TaskHandler(AssassinBaseHandler):
         status = self.get_argument('status')
         extra = self.get_argument('extra', "{}")
         extra = json.loads(extra)
-        tt = Task.create(task_key=task_key, execute_func=execute_func, trigger=trigger, spec=spec,
-                         args=args, is_valid=is_valid, status=status, extra=extra, desc=desc)
+        tt = await objects.create(Task, task_key=task_key, execute_func=execute_func, trigger=trigger, spec=spec,
+                                  args=args, is_valid=is_valid, status=status, extra=extra, desc=desc)
+        # 通知调度进程立即同步
+        await publish_task_changed(tt.id)
         return self.finish_success(tt.id)
 
     async def put(self, *args, **kwargs):
@@ -246,7 +300,7 @@ class TaskHandler(AssassinBaseHandler):
         if err is not None:
             raise BadRequestException('Trigger:`{}` and Spec:`{}` does not match'.format(trigger, spec))
         task_id = self.get_argument('task_id')
-        task = Task.select().filter(Task.id == task_id).first()
+        task = await first(Task.select().filter(Task.id == task_id))
         if not task:
             raise BadRequestException('task_id: `{}` is invalid'.format(task_id))
         is_valid = self.get_argument('is_valid')
@@ -263,7 +317,11 @@ class TaskHandler(AssassinBaseHandler):
         task.status = status
         task.args = args
         task.extra = extra
-        task.save()
+        # 只保存修改的字段: 显式写入读取到的 update_at 会让 MySQL 的 ON UPDATE CURRENT_TIMESTAMP 失效、增量同步拉取不到
+        await objects.update(task, only=[Task.trigger, Task.desc, Task.spec, Task.is_valid, Task.status, Task.args,
+                                         Task.extra])
+        # 通知调度进程立即同步
+        await publish_task_changed(task.id)
         return self.finish_success()
 
     @staticmethod
@@ -324,10 +382,22 @@ class SubTasksHandler(AssassinBaseHandler):
                 default: 1
             -   name: size
                 in: query
-                description: 每页展示条数(默认20)
+                description: 每页展示条数(默认20、最大100)
                 required: true
                 type: integer
                 default: 20
+            -   name: after_id
+                in: query
+                description: 游标分页、返回id小于after_id的数据(传入之后忽略page)
+                required: false
+                type: integer
+            -   name: with_total
+                in: query
+                description: 游标分页时是否返回总数(缓存)
+                required: false
+                type: integer
+                enum: [0, 1]
+                default: 0
         responses:
             200:
               description: list of tasks
@@ -337,26 +407,94 @@ class SubTasksHandler(AssassinBaseHandler):
               description: page and size should be int
         """
         task_id = self.get_argument('task_id')
-        page = self.get_argument('page', '1')
-        size = self.get_argument('size', '20')
-        if not page.isdigit() or not size.isdigit():
-            raise BadRequestException('page and size should be int')
+        page, size, after_id, with_total = self.get_page_arguments()
         query = TaskExecute.select().filter(TaskExecute.task_id == task_id).order_by(-TaskExecute.id)
-        cnt = query.count()
-        subs = query.paginate((int(page) - 1) * int(size), int(size)).dicts()
+        cnt = None
+        if after_id is not None:
+            subs = await objects.execute(query.where(TaskExecute.id < after_id).limit(size).dicts())
+        else:
+            subs = await objects.execute(query.paginate(page, size).dicts())
+        # 游标分页只在需要时返回总数
+        if after_id is None or with_total:
+            cnt = await cached_count(('sub_tasks', task_id), query)
         subs = list(subs)
         for sub in subs:
             sub['create_at'] = datetime_fmt(sub['create_at'])
             sub['update_at'] = datetime_fmt(sub['update_at'])
+            for column in ('scheduled_at', 'lock_at', 'start_at', 'end_at'):
+                sub[column] = datetime_ms_fmt(sub.get(column))
         rst = {
-            'page': page,
-            'size': size,
+            'page': str(page),
+            'size': str(size),
             'total': cnt,
+            'next_after_id': subs[-1]['id'] if subs and len(subs) == size else None,
             'data': subs
         }
         return self.finish_success(rst)
 
 
+class TaskStatsHandler(AssassinBaseHandler):
+    # 统计窗口上限(分钟)
+    MAX_MINUTES = 7 * 24 * 60
+
+    async def get(self, *args, **kwargs):
+        """
+        ---
+        tags:
+            - Tasks
+        summary: Get task stats
+        description: p50/p95/p99 of duration and lateness(ms) in the last N minutes, grouped by task
+        produces:
+            - application/json
+        parameters:
+            -   name: minutes
+                in: query
+                description: 统计最近N分钟(默认60、最大10080)
+                required: false
+                type: integer
+                default: 60
+            -   name: task_id
+                in: query
+                description: 任务ID(不传统计所有任务)
+                required: false
+                type: integer
+        responses:
+            200:
+              description: list of task stats
+              schema:
+                $ref: '#/definitions/TaskStatsModel'
+            400:
+              description: minutes and task_id should be int
+            501:
+              description: database does not support window functions (requires MySQL 8.0+)
+        """
+        minutes = self.get_argument('minutes', '60')
+        task_id = self.get_argument('task_id', '')
+        if not minutes.isdigit() or (task_id and not task_id.isdigit()):
+            raise BadRequestException('minutes and task_id should be int')
+        minutes = min(max(int(minutes), 1), self.MAX_MINUTES)
+        since = datetime.now() - timedelta(minutes=minutes)
+        try:
+            stats = await TaskExecute.async_percentile_stats(since, task_id=int(task_id) if task_id else None)
+        except WindowFunctionUnavailable:
+            raise NotImplementedException('task_stats requires MySQL 8.0+ (window functions)')
+        tasks = {}
+        if stats:
+            rows = await objects.execute(Task.select(Task.id, Task.task_key).
+                                         where(Task.id.in_([s['task_id'] for s in stats])))
+            tasks = {t.id: t.task_key for t in rows}
+        for item in stats:
+            item['task_key'] = tasks.get(item['task_id'])
+            # AVG 返回 Decimal
+            item['duration_avg'] = float(item['duration_avg']) if item['duration_avg'] is not None else None
+        rst = {
+            'minutes': minutes,
+            'since': datetime_fmt(since),
+            'data': stats
+        }
+        return self.finish_success(rst)
+
+
 @register_swagger_model
 class TaskModel:
     """
@@ -407,3 +545,35 @@ class SubTaskModel:
         update_at:
             type: string
     """
+
+
+@register_swagger_model
+class TaskStatsModel:
+    """
+    ---
+    type: object
+    description: Task stats representation(ms)
+    properties:
+        task_id:
+            type: integer
+        task_key:
+            type: string
+        runs:
+            type: integer
+        duration_avg:
+            type: number
+        duration_max:
+            type: integer
+        duration_p50:
+            type: integer
+        duration_p95:
+            type: integer
+        duration_p99:
+            type: integer
+        lateness_p50:
+            type: integer
+        lateness_p95:
+            type: integer
+        lateness_p99:
+            type: integer
+    """
@@ -15,3 +15,8 @@ class BadRequestException(AssassinException):
 class PermissionException(AssassinException):
     def __init__(self, msg):
         super(PermissionException, self).__init__(403, msg)
+
+
+class NotImplementedException(AssassinException):
+    def __init__(self, msg):
+        super(NotImplementedException, self).__init__(501, msg)
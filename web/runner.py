@@ -0,0 +1,73 @@
+"""
+接口服务进程管理
+web.py 以独立进程组启动: 主进程绑定端口之后 fork 多个 worker 共享监听socket、并负责重启异常退出的 worker
+调度进程负责拉起、巡检(主进程退出之后重新拉起)以及退出时关闭整个进程组
+"""
+import os
+import sys
+import signal
+import subprocess
+
+from libs.logger import LoggerPool
+
+logger = LoggerPool.apscheduler
+
+
+class ApiRunner:
+    """
+    >>> runner = ApiRunner('/path/to/web.py', port=8888, workers=0)
+    >>> runner.start()
+    >>> await runner.supervise()   # 定时巡检
+    >>> runner.terminate()         # 收到term信号
+    >>> runner.kill()              # 退出前确保进程组已关闭
+    """
+    def __init__(self, script, port=8888, workers=0, max_restarts=100):
+        self.script = script
+        self.port = port
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.process = None
+        self.stopping = False
+
+    def start(self):
+        cmd = [sys.executable, self.script, '--port={}'.format(self.port), '--workers={}'.format(self.workers),
+               '--max_restarts={}'.format(self.max_restarts)]
+        # 独立进程组、退出时可以一次性关闭主进程和所有worker
+        self.process = subprocess.Popen(cmd, start_new_session=True)
+        logger.info({'keyword': 'api_runner_start', 'pid': self.process.pid, 'port': self.port,
+                     'workers': self.workers})
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    async def supervise(self):
+        """
+        巡检接口服务主进程、退出之后重新拉起
+        """
+        if self.stopping or self.is_running():
+            return
+        logger.error({'panic_keyword': 'api_runner_exited',
+                      'returncode': self.process.returncode if self.process else None})
+        self.start()
+
+    def send_signal(self, signum):
+        if not self.is_running():
+            return
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.stopping = True
+        self.send_signal(signal.SIGTERM)
+        logger.info({'keyword': 'api_runner_terminate', 'pid': self.process.pid if self.process else None})
+
+    def kill(self, timeout=3):
+        self.stopping = True
+        if not self.is_running():
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.send_signal(signal.SIGKILL)